@@ -8,31 +8,47 @@ using lego, stores locally, distributes to /etc/ssl/ on remote servers.
 Usage:
     python deploy.py status
     python deploy.py issue [--force]
-    python deploy.py distribute [HOST]
-    python deploy.py renew
+    python deploy.py distribute [HOST] [--asyncssh]
+    python deploy.py renew [--asyncssh]
 """
+import asyncio
+import functools
+import io
+import json
 import os
 import sys
 import subprocess
 import time
+import select
 import signal
 import shutil
+import socket
 import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime, timezone
 
+from cryptography import x509
+
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 from lib.sops import decrypt_sops
 from lib.deploy import load_hosts, resolve_target
-from lib.remote import ssh_run, rsync_file
+from lib.remote import ssh_run_script, rsync_many
 
 BASE = Path(__file__).parent
 CERT_STORE = BASE / ".certstore"
 SECRETS_FILE = BASE / "secrets" / "secrets.enc.yaml"
+EXPIRY_CACHE = CERT_STORE / ".expiry_cache.json"
 
 RENEW_DAYS = 30
 DOH_PROXY_PORT = 5053
 
+MAX_PARALLEL = 8  # stay under sshd MaxStartups
+
+_print_lock = threading.Lock()
+
 
 def start_doh_proxy() -> subprocess.Popen:
     """Start a local DNS proxy with DoH upstream for lego."""
@@ -41,10 +57,28 @@ def start_doh_proxy() -> subprocess.Popen:
          "-u", "https://1.1.1.1/dns-query"],
         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
     )
-    time.sleep(1)
+    _wait_dns_ready(proc)
     return proc
 
 
+def _wait_dns_ready(proc: subprocess.Popen, timeout: float = 2.0):
+    """Poll the proxy with a root NS query until it answers."""
+    # id=0x1234, RD, 1 question: "." NS IN
+    query = b"\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x02\x00\x01"
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.connect(("127.0.0.1", DOH_PROXY_PORT))
+        while time.monotonic() < deadline and proc.poll() is None:
+            try:
+                sock.send(query)
+                if select.select([sock], [], [], 0.05)[0]:
+                    sock.recv(512)
+                    return
+            except ConnectionRefusedError:
+                # ICMP port unreachable: not listening yet
+                time.sleep(0.05)
+
+
 def stop_doh_proxy(proc: subprocess.Popen):
     proc.send_signal(signal.SIGTERM)
     proc.wait(timeout=5)
@@ -57,17 +91,55 @@ def cert_paths(domain: str) -> tuple[Path, Path]:
 
 
 def read_expiry(cert_file: Path) -> datetime | None:
-    """Read expiry date from a PEM certificate via openssl."""
-    r = subprocess.run(
-        ["openssl", "x509", "-enddate", "-noout", "-in", str(cert_file)],
-        capture_output=True, text=True,
-    )
-    if r.returncode != 0:
+    """Read expiry date from a PEM certificate, via the on-disk cache."""
+    try:
+        st = cert_file.stat()
+    except OSError:
         return None
-    date_str = r.stdout.strip().split("=", 1)[1]
-    return datetime.strptime(date_str, "%b %d %H:%M:%S %Y %Z").replace(
-        tzinfo=timezone.utc
-    )
+
+    cache = _load_expiry_cache()
+    hit = cache.get(str(cert_file))
+    if hit and hit["mtime_ns"] == st.st_mtime_ns and hit["size"] == st.st_size:
+        return datetime.fromisoformat(hit["expiry_iso"])
+
+    expiry = _parse_expiry(cert_file, st.st_mtime_ns, st.st_size)
+    if expiry:
+        cache[str(cert_file)] = {
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+            "expiry_iso": expiry.isoformat(),
+        }
+        _save_expiry_cache(cache)
+    return expiry
+
+
+def _load_expiry_cache() -> dict:
+    try:
+        return json.loads(EXPIRY_CACHE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_expiry_cache(cache: dict):
+    tmp = EXPIRY_CACHE.with_suffix(".tmp")
+    try:
+        with open(tmp, "w") as f:
+            json.dump(cache, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, EXPIRY_CACHE)
+    except OSError:
+        pass
+
+
+@functools.lru_cache(maxsize=16)
+def _parse_expiry(cert_file: Path, mtime_ns: int, size: int) -> datetime | None:
+    # mtime_ns and size are part of the cache key so a renewed cert is re-read
+    try:
+        cert = x509.load_pem_x509_certificate(cert_file.read_bytes())
+    except (OSError, ValueError):
+        return None
+    return cert.not_valid_after_utc
 
 
 def issue(secrets: dict, force: bool = False) -> bool:
@@ -118,7 +190,7 @@ def issue(secrets: dict, force: bool = False) -> bool:
             **os.environ,
             "CLOUDFLARE_DNS_API_TOKEN": secrets["cf_api_token"],
             "CLOUDFLARE_PROPAGATION_TIMEOUT": "15",
-            "CLOUDFLARE_POLLING_INTERVAL": "5",
+            "CLOUDFLARE_POLLING_INTERVAL": "2",
         }
 
         print(f"  requesting *.{domain} ...")
@@ -134,11 +206,14 @@ def issue(secrets: dict, force: bool = False) -> bool:
         print("ERROR: certificate not found after lego run", file=sys.stderr)
         sys.exit(1)
 
+    EXPIRY_CACHE.unlink(missing_ok=True)
+
     print(f"  \033[0;32m✓\033[0m certificate ready")
     return True
 
 
-def distribute(secrets: dict, hosts: dict, only_host: str = None):
+def distribute(secrets: dict, hosts: dict, only_host: str = None,
+               use_asyncssh: bool = False):
     """Push certificate and key to target servers at /etc/ssl/."""
     domain = secrets["domain"]
     crt, key = cert_paths(domain)
@@ -157,35 +232,131 @@ def distribute(secrets: dict, hosts: dict, only_host: str = None):
             avail = ", ".join(t["host"] for t in secrets["targets"])
             print(f"ERROR: '{only_host}' not in targets ({avail})", file=sys.stderr)
             sys.exit(1)
+    if not targets:
+        return
+
+    # Resolved up front: resolve_target exits, which must not happen in a
+    # worker or the event loop while other hosts are mid-upload
+    resolved = [(t, *resolve_target(hosts, t["host"])) for t in targets]
+
+    if use_asyncssh:
+        try:
+            from lib import remote_async
+        except ImportError:
+            print("ERROR: --asyncssh needs 'pip install asyncssh'", file=sys.stderr)
+            sys.exit(1)
+        failed = asyncio.run(_distribute_async(remote_async, resolved, crt, key,
+                                               remote_crt, remote_key))
+    else:
+        failed = []
+        with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL, len(resolved))) as ex:
+            futs = {ex.submit(_push_to_target, t, target, port, crt, key,
+                              remote_crt, remote_key): t["host"]
+                    for t, target, port in resolved}
+            for f in as_completed(futs):
+                try:
+                    f.result()
+                except SystemExit:
+                    failed.append(futs[f])
+
+    if failed:
+        print(f"Failed: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
 
-    for t in targets:
-        host_ref = t["host"]
-        target, port = resolve_target(hosts, host_ref)
-        print(f"\n\033[1;36m── {host_ref} ({target}) ──\033[0m")
 
-        ssh_run(target, "mkdir -p /etc/ssl/certs /etc/ssl/private", port)
+async def _distribute_async(remote_async, resolved, crt, key, remote_crt, remote_key):
+    """Push to every target; returns the hosts that failed once all are done."""
+    sem = asyncio.Semaphore(MAX_PARALLEL)
 
-        changed = False
+    async def push(t, target, port):
+        async with sem:
+            await _push_async(remote_async, t, target, port, crt, key,
+                              remote_crt, remote_key)
 
-        if rsync_file(crt, target, remote_crt, port):
-            print(f"  \033[1;33m→\033[0m {remote_crt} updated")
-            changed = True
-        else:
-            print(f"  \033[0;32m✓\033[0m {remote_crt} unchanged")
+    try:
+        results = await asyncio.gather(*(push(*r) for r in resolved),
+                                       return_exceptions=True)
+    finally:
+        await remote_async.close_all()
 
-        if rsync_file(key, target, remote_key, port):
-            print(f"  \033[1;33m→\033[0m {remote_key} updated")
-            changed = True
-        else:
-            print(f"  \033[0;32m✓\033[0m {remote_key} unchanged")
+    failed = []
+    for (t, _, _), res in zip(resolved, results):
+        if isinstance(res, remote_async.RemoteError):
+            failed.append(t["host"])
+        elif isinstance(res, BaseException):
+            raise res
+    return failed
 
-        ssh_run(target, f"chmod 644 {remote_crt} && chmod 600 {remote_key}", port)
 
-        if changed and "post_deploy" in t:
-            ssh_run(target, t["post_deploy"], port)
-            print(f"  \033[0;32m✓\033[0m post-deploy done")
+async def _push_async(remote_async, t: dict, target: str, port: int, crt: Path,
+                      key: Path, remote_crt: str, remote_key: str):
+    """asyncssh variant of _push_to_target: one connection, many channels."""
+    out = io.StringIO()
+    try:
+        print(f"\n\033[1;36m── {t['host']} ({target}) ──\033[0m", file=out)
+
+        await remote_async.run(target, "mkdir -p /etc/ssl/certs /etc/ssl/private", port)
+
+        changed = False
+        for local, rp in ((crt, remote_crt), (key, remote_key)):
+            if await remote_async.put(target, local, rp, port):
+                print(f"  \033[1;33m→\033[0m {rp} updated", file=out)
+                changed = True
+            else:
+                print(f"  \033[0;32m✓\033[0m {rp} unchanged", file=out)
+
+        cmd = f"chmod 644 {remote_crt} && chmod 600 {remote_key}"
+        post_deploy = changed and "post_deploy" in t
+        if post_deploy:
+            # post_deploy runs as written, not spliced into the && chain
+            cmd += f" || exit 1\n{t['post_deploy']}"
+        await remote_async.run(target, cmd, port)
+
+        if post_deploy:
+            print(f"  \033[0;32m✓\033[0m post-deploy done", file=out)
         elif not changed:
-            print(f"  \033[0;32m✓\033[0m no changes")
+            print(f"  \033[0;32m✓\033[0m no changes", file=out)
+    finally:
+        with _print_lock:
+            sys.stdout.write(out.getvalue())
+            sys.stdout.flush()
+
+
+def _push_to_target(t: dict, target: str, port: int, crt: Path, key: Path,
+                    remote_crt: str, remote_key: str):
+    """Push cert and key to one target; output is buffered per host."""
+    out = io.StringIO()
+    try:
+        print(f"\n\033[1;36m── {t['host']} ({target}) ──\033[0m", file=out)
+
+        # lego output keeps its mtime until renewal, so the quick check is enough
+        with tempfile.TemporaryDirectory() as staging:
+            updated = rsync_many(Path(staging), target,
+                                 [(crt, remote_crt), (key, remote_key)], port,
+                                 setup_dirs=["/etc/ssl/certs", "/etc/ssl/private"])
+        changed = bool(updated)
+
+        for rp in (remote_crt, remote_key):
+            if rp in updated:
+                print(f"  \033[1;33m→\033[0m {rp} updated", file=out)
+            else:
+                print(f"  \033[0;32m✓\033[0m {rp} unchanged", file=out)
+
+        script = ["set -e", f"chmod 644 {remote_crt}", f"chmod 600 {remote_key}"]
+        post_deploy = changed and "post_deploy" in t
+        if post_deploy:
+            # set -e is for the chmods only; post_deploy runs as written
+            script += ["set +e", t["post_deploy"]]
+        ssh_run_script(target, "\n".join(script) + "\n", port)
+
+        if post_deploy:
+            print(f"  \033[0;32m✓\033[0m post-deploy done", file=out)
+        elif not changed:
+            print(f"  \033[0;32m✓\033[0m no changes", file=out)
+    finally:
+        with _print_lock:
+            sys.stdout.write(out.getvalue())
+            sys.stdout.flush()
 
 
 def status(secrets: dict):
@@ -215,6 +386,8 @@ def main():
     parser.add_argument("command", choices=["status", "issue", "distribute", "renew"])
     parser.add_argument("host", nargs="?", help="target host (for distribute)")
     parser.add_argument("--force", action="store_true")
+    parser.add_argument("--asyncssh", action="store_true",
+                        help="distribute over in-process asyncssh connections")
     args = parser.parse_args()
 
     secrets = decrypt_sops(SECRETS_FILE)
@@ -225,10 +398,10 @@ def main():
     elif args.command == "issue":
         issue(secrets, force=args.force)
     elif args.command == "distribute":
-        distribute(secrets, hosts, only_host=args.host)
+        distribute(secrets, hosts, only_host=args.host, use_asyncssh=args.asyncssh)
     elif args.command == "renew":
         issue(secrets)
-        distribute(secrets, hosts)
+        distribute(secrets, hosts, use_asyncssh=args.asyncssh)
 
 
 if __name__ == "__main__":
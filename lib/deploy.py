@@ -1,15 +1,30 @@
-import subprocess
+import hashlib
+import io
+import os
 import sys
 import tempfile
+import threading
 import argparse
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import ContextVar
 from pathlib import Path
 
 from lib.sops import decrypt_sops
-from lib.remote import ssh_run, ssh_read_file, rsync_file
+from lib.remote import ssh_run_script, ssh_read_files, ssh_sha256_many, rsync_many
 from lib.jinja import create_jinja_env
+from lib.diffcolor import colored_udiff
 
 HOSTS_FILE = Path(__file__).resolve().parent.parent / 'secrets' / 'hosts.enc.yaml'
 
+MAX_WORKERS = 8
+
+OK = '\033[0;32m✓\033[0m'
+ARROW = '\033[1;33m→\033[0m'
+
+_out: ContextVar[io.StringIO | None] = ContextVar('_out', default=None)
+_flush_lock = threading.Lock()
+
 
 def load_hosts() -> dict:
     return decrypt_sops(HOSTS_FILE)
@@ -37,16 +52,110 @@ def _fmt_opts(opts: dict) -> str:
     return f' ({", ".join(parts)})' if parts else ''
 
 
-def _apply_opts(opts: dict, rp: str, target: str, port: int):
+def _opts_cmds(opts: dict, rp: str) -> list[str]:
     if not opts:
-        return
+        return []
     cmds = []
     if 'owner' in opts:
         cmds.append(f'chown {opts["owner"]} {rp}')
     if 'mode' in opts:
         cmds.append(f'chmod {opts["mode"]} {rp}')
-    if cmds:
-        ssh_run(target, ' && '.join(cmds), port)
+    return cmds
+
+
+# Stamps fall in 2020-09..2029-03: far below the 2038 limit of filesystems
+# without 64-bit timestamps, which would otherwise clamp them
+_STAMP_BASE = 1_600_000_000
+_STAMP_SPAN = 1 << 28
+
+
+def _stamp(path: Path, data: bytes):
+    """Set mtime from a content hash: same bytes, same mtime, across runs.
+
+    Lets rsync's size+mtime quick check stand in for --checksum on freshly
+    rendered files.
+    """
+    h = int.from_bytes(hashlib.sha256(data).digest()[:4], 'big')
+    t = _STAMP_BASE + h % _STAMP_SPAN
+    os.utime(path, (t, t))
+
+
+def _freeze(value):
+    # Hashable, order-independent form of a YAML value. Keys need not be
+    # sortable, and the type tag keeps 1, '1', 1.0 and True apart
+    if isinstance(value, dict):
+        return frozenset((_freeze(k), _freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return type(value), value
+
+
+def _render_key(tpl: str, ctx: dict) -> tuple | None:
+    """Memo key for a render, or None if the context can't be hashed."""
+    # Identical contexts (e.g. instances sharing settings) share one render
+    try:
+        key = tpl, _freeze(ctx)
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+class _InstanceStdout:
+    """sys.stdout proxy that routes writes to the current instance's buffer."""
+
+    def __init__(self, real):
+        self.real = real
+
+    def write(self, s):
+        return (_out.get() or self.real).write(s)
+
+    def writelines(self, lines):
+        (_out.get() or self.real).writelines(lines)
+
+    def flush(self):
+        (_out.get() or self.real).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.real, name)
+
+
+def _buffered(fn, *args):
+    buf = io.StringIO()
+    token = _out.set(buf)
+    try:
+        fn(*args)
+    finally:
+        _out.reset(token)
+        with _flush_lock:
+            sys.stdout.write(buf.getvalue())
+            sys.stdout.flush()
+
+
+def _run_parallel(fn, instances: list):
+    """Run fn(instance) concurrently, printing each instance's output as a block."""
+    if len(instances) <= 1:
+        for inst in instances:
+            fn(inst)
+        return
+
+    real = sys.stdout
+    sys.stdout = _InstanceStdout(real)
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(instances))) as ex:
+            futs = {ex.submit(_buffered, fn, inst): inst for inst in instances}
+            for f in as_completed(futs):
+                try:
+                    f.result()
+                except SystemExit:
+                    failed.append(futs[f])
+    finally:
+        sys.stdout = real
+
+    if failed:
+        print(f"Failed: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
 
 
 class ServiceDeployer:
@@ -60,10 +169,14 @@ class ServiceDeployer:
         self.secrets_file = config['secrets_file']
         self.multi_instance = config.get('multi_instance', False)
         self.instances_key = config.get('instances_key', 'instances')
+        self._rendered = {}
 
     def _get_env(self):
         return create_jinja_env(self.templates_dir)
 
+    def _get_files(self, secrets, instance_name=None):
+        return self.files(secrets, instance_name) if callable(self.files) else self.files
+
     def _get_host_ref(self, secrets, instance_name=None):
         if self.multi_instance:
             return secrets[self.instances_key][instance_name]['host']
@@ -92,16 +205,33 @@ class ServiceDeployer:
             remote_path = remote_path(secrets)
         return tpl, remote_path, opts
 
+    def _preload_templates(self, env, secrets, instances):
+        names = set()
+        for inst in instances:
+            files = self._get_files(secrets, inst)
+            names.update(entry[0] for entry in files)
+        for name in names:
+            env.get_template(name)
+
+    def _render(self, env, tpl, ctx, instance_name=None):
+        key = _render_key(tpl, ctx)
+        if key is None:
+            return env.get_template(tpl).render(**ctx)
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            rendered = self._rendered[key] = env.get_template(tpl).render(**ctx)
+        return rendered
+
     def render(self, secrets, env, instance_name=None):
         ctx = self._build_context(secrets, instance_name)
         label = instance_name or self._get_host_ref(secrets)
         print(f"\033[1;36m── {label} ──\033[0m")
-        files = self.files(secrets, instance_name) if callable(self.files) else self.files
+        files = self._get_files(secrets, instance_name)
         for entry in files:
             tpl, rp, opts = self._parse_file_entry(entry, secrets)
             name = tpl.removesuffix('.j2')
             print(f"\033[1;33m═══ {name} → {rp}{_fmt_opts(opts)} ═══\033[0m")
-            print(env.get_template(tpl).render(**ctx))
+            print(self._render(env, tpl, ctx, instance_name))
             print()
 
     def diff(self, hosts, secrets, env, instance_name=None):
@@ -109,64 +239,86 @@ class ServiceDeployer:
         target, port = self._get_target(hosts, secrets, instance_name)
         label = instance_name or self._get_host_ref(secrets)
         print(f"\033[1;36m── {label} ({target}) ──\033[0m")
-        files = self.files(secrets, instance_name) if callable(self.files) else self.files
-        for entry in files:
-            tpl, rp, opts = self._parse_file_entry(entry, secrets)
+        files = self._get_files(secrets, instance_name)
+        entries = [self._parse_file_entry(entry, secrets) for entry in files]
+        rendered = {rp: self._render(env, tpl, ctx, instance_name) for tpl, rp, _ in entries}
+        encoded = {rp: text.encode() for rp, text in rendered.items()}
+
+        # One call for every hash, one more for only the files that differ
+        hashes = ssh_sha256_many(target, list(encoded), port)
+        mismatched = [rp for rp, data in encoded.items()
+                      if hashes.get(rp) != hashlib.sha256(data).hexdigest()]
+        remote = ssh_read_files(target, mismatched, port) if mismatched else {}
+
+        for tpl, rp, opts in entries:
             name = tpl.removesuffix('.j2')
-            rendered = env.get_template(tpl).render(**ctx)
-            remote_content = ssh_read_file(target, rp, port)
-            if rendered == remote_content:
-                print(f"  \033[0;32m✓\033[0m {name}{_fmt_opts(opts)}")
+            # Byte comparison covers a remote without sha256sum
+            if rp not in remote or remote[rp] == encoded[rp]:
+                print(f"  {OK} {name}{_fmt_opts(opts)}")
             else:
-                print(f"  \033[1;33m→\033[0m {name} differs{_fmt_opts(opts)}")
-                with tempfile.NamedTemporaryFile(mode='w', suffix='.txt') as lf, \
-                     tempfile.NamedTemporaryFile(mode='w', suffix='.txt') as rf:
-                    lf.write(rendered); lf.flush()
-                    rf.write(remote_content); rf.flush()
-                    subprocess.run(['diff', '--color', '-u', rf.name, lf.name])
+                print(f"  {ARROW} {name} differs{_fmt_opts(opts)}")
+                remote_content = remote[rp].decode('utf-8', 'replace')
+                sys.stdout.writelines(colored_udiff(remote_content, rendered[rp], rp, 'rendered'))
                 print()
 
-    def deploy(self, hosts, secrets, env, instance_name=None, no_restart=False):
+    def deploy(self, hosts, secrets, env, instance_name=None, no_restart=False,
+               staging_root=None, force=False):
         ctx = self._build_context(secrets, instance_name)
         target, port = self._get_target(hosts, secrets, instance_name)
         label = instance_name or self._get_host_ref(secrets)
-        print(f"\033[1;33m→\033[0m deploying {label} to {target}")
+        print(f"{ARROW} deploying {label} to {target}")
 
-        files = self.files(secrets, instance_name) if callable(self.files) else self.files
+        files = self._get_files(secrets, instance_name)
         setup_dirs = self.setup_dirs(secrets, instance_name) if callable(self.setup_dirs) else self.setup_dirs
 
-        if setup_dirs:
-            ssh_run(target, f"mkdir -p {' '.join(setup_dirs)}", port)
+        entries = [self._parse_file_entry(entry, secrets) for entry in files]
+        rendered = {rp: self._render(env, tpl, ctx, instance_name).encode()
+                    for tpl, rp, _ in entries}
 
-        changed = False
-        with tempfile.TemporaryDirectory() as tmpdir:
+        # Callers deploying many instances share one staging_root, one subdir each
+        staging = staging_root / label if staging_root else None
+        with nullcontext(staging) if staging else tempfile.TemporaryDirectory() as tmpdir:
             tmpdir = Path(tmpdir)
-            for entry in files:
-                tpl, rp, opts = self._parse_file_entry(entry, secrets)
-                rendered = env.get_template(tpl).render(**ctx)
-                local_file = tmpdir / tpl.removesuffix('.j2')
-                local_file.write_text(rendered)
-                if rsync_file(local_file, target, rp, port):
-                    print(f"  \033[1;33m→\033[0m {tpl.removesuffix('.j2')} updated")
-                    changed = True
-                else:
-                    print(f"  \033[0;32m✓\033[0m {tpl.removesuffix('.j2')} unchanged")
-                _apply_opts(opts, rp, target, port)
+            tmpdir.mkdir(parents=True, exist_ok=True)
+            file_map = []
+            for rp, data in rendered.items():
+                local_file = tmpdir / rp.lstrip('/')
+                local_file.parent.mkdir(parents=True, exist_ok=True)
+                local_file.write_bytes(data)
+                _stamp(local_file, data)
+                file_map.append((local_file, rp))
+            updated = rsync_many(tmpdir, target, file_map, port, force=force,
+                                 setup_dirs=setup_dirs)
+
+        sys.stdout.write(''.join(
+            f"  {ARROW} {tpl.removesuffix('.j2')} updated\n" if rp in updated
+            else f"  {OK} {tpl.removesuffix('.j2')} unchanged\n"
+            for tpl, rp, _ in entries))
+        changed = bool(updated)
 
         for hook in self.secrets_hooks:
             hook(secrets, target, port)
 
-        if not no_restart and changed and self.restart_cmd:
+        # Ownership/mode fixups and the restart share one ssh session. Only
+        # the fixups run under set -e: restart commands may tolerate failing
+        # steps on purpose, and their own exit status decides the result
+        fixups = [cmd for _, rp, opts in entries for cmd in _opts_cmds(opts, rp)]
+        script = ['set -e', *fixups] if fixups else []
+        restart = not no_restart and changed and self.restart_cmd
+        if restart:
             if callable(self.restart_cmd):
-                cmd = self.restart_cmd(secrets, instance_name)
+                script += ['set +e', self.restart_cmd(secrets, instance_name)]
             else:
-                cmd = self.restart_cmd
-            ssh_run(target, cmd, port)
-            print(f"  \033[0;32m✓\033[0m restarted")
+                script += ['set +e', self.restart_cmd]
+        if script:
+            ssh_run_script(target, '\n'.join(script) + '\n', port)
+
+        if restart:
+            print(f"  {OK} restarted")
         elif not changed:
-            print(f"  \033[0;32m✓\033[0m no changes")
+            print(f"  {OK} no changes")
 
-        print(f"\033[0;32m✓\033[0m {label} done\n")
+        print(f"{OK} {label} done\n")
 
     def run_cli(self):
         parser = argparse.ArgumentParser()
@@ -175,10 +327,10 @@ class ServiceDeployer:
         parser.add_argument('-s', '--secrets', default=str(self.secrets_file))
         parser.add_argument('--all', action='store_true')
         parser.add_argument('--no-restart', action='store_true')
+        parser.add_argument('--force', action='store_true')
         args = parser.parse_args()
 
         secrets = decrypt_sops(Path(args.secrets))
-        env = self._get_env()
         hosts = load_hosts()
 
         if self.multi_instance:
@@ -202,22 +354,38 @@ class ServiceDeployer:
             else:
                 parser.error(f"'{args.command}' requires instance name(s) or --all")
 
+            env = self._get_env()
+            self._preload_templates(env, secrets, instances)
+            if args.command == 'deploy':
+                with tempfile.TemporaryDirectory() as root:
+                    _run_parallel(
+                        lambda inst: self.deploy(hosts, secrets, env, inst,
+                                                 no_restart=args.no_restart,
+                                                 staging_root=Path(root),
+                                                 force=args.force),
+                        instances,
+                    )
+                return
+
+            if args.command == 'diff':
+                _run_parallel(lambda inst: self.diff(hosts, secrets, env, inst), instances)
+                return
+
+            # render is local and cheap, keep order
             for inst in instances:
-                if args.command == 'render':
-                    self.render(secrets, env, inst)
-                elif args.command == 'diff':
-                    self.diff(hosts, secrets, env, inst)
-                elif args.command == 'deploy':
-                    self.deploy(hosts, secrets, env, inst, no_restart=args.no_restart)
+                self.render(secrets, env, inst)
         else:
             if args.command == 'list':
                 host_ref = secrets['host']
                 addr = hosts.get(host_ref, {}).get('address', '?')
                 print(f"  {host_ref}\t{addr}")
                 return
+            env = self._get_env()
+            self._preload_templates(env, secrets, [None])
             if args.command == 'render':
                 self.render(secrets, env)
             elif args.command == 'diff':
                 self.diff(hosts, secrets, env)
             elif args.command == 'deploy':
-                self.deploy(hosts, secrets, env, no_restart=args.no_restart)
+                self.deploy(hosts, secrets, env, no_restart=args.no_restart,
+                            force=args.force)
@@ -0,0 +1,35 @@
+import difflib
+import os
+from typing import Iterable
+
+# Same palette as GNU `diff --color`
+_HEADER = '\033[1m'
+_HUNK = '\033[36m'
+_DEL = '\033[31m'
+_ADD = '\033[32m'
+_RESET = '\033[0m'
+
+
+def _color(line: str) -> str:
+    if line.startswith('@@'):
+        return f'{_HUNK}{line}{_RESET}'
+    if line.startswith('-'):
+        return f'{_DEL}{line}{_RESET}'
+    if line.startswith('+'):
+        return f'{_ADD}{line}{_RESET}'
+    return line
+
+
+def colored_udiff(a: str, b: str, fromfile: str = '', tofile: str = '') -> Iterable[str]:
+    """Unified diff of a → b as newline-terminated, ANSI-colored lines."""
+    color = not os.environ.get('NO_COLOR')
+    lines = difflib.unified_diff(a.splitlines(keepends=True),
+                                 b.splitlines(keepends=True),
+                                 fromfile, tofile)
+    # Only the first two lines are the ---/+++ header; later lines starting
+    # with them are content (e.g. a removed YAML '---' marker)
+    for i, line in enumerate(lines):
+        line = line.rstrip('\n')
+        if color:
+            line = f'{_HEADER}{line}{_RESET}' if i < 2 else _color(line)
+        yield line + '\n'
@@ -1,10 +1,21 @@
+from __future__ import annotations
+
 from pathlib import Path
-from jinja2 import Environment, FileSystemLoader
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from jinja2 import Environment
 
 
 def create_jinja_env(templates_dir: Path) -> Environment:
+    # Imported here so commands that never render (e.g. `list`) skip jinja2
+    from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+    # Default cache dir is a per-user 0700 directory under the system tmp
     return Environment(
         loader=FileSystemLoader(templates_dir),
+        bytecode_cache=FileSystemBytecodeCache(),
+        auto_reload=False,
         trim_blocks=True,
         lstrip_blocks=True,
         keep_trailing_newline=True,
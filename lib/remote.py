@@ -1,11 +1,58 @@
+import atexit
+import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 from pathlib import Path
 
+# One multiplexed master connection per host, shared by every ssh/rsync call.
+# The socket dir is created on first use, so importers that never connect
+# (list, worker processes) leave nothing behind
+_ctl_dir: str | None = None
+_ctl_lock = threading.Lock()
+
+
+def _control_dir() -> str:
+    global _ctl_dir
+    with _ctl_lock:
+        if _ctl_dir is None:
+            _ctl_dir = tempfile.mkdtemp(prefix='infra-ssh-')
+        return _ctl_dir
+
+
+def close_masters() -> None:
+    """Stop every master started by this process and remove the socket dir."""
+    if _ctl_dir is None:
+        return
+    for sock in Path(_ctl_dir).iterdir() if Path(_ctl_dir).is_dir() else ():
+        # the host argument is ignored when ControlPath names the socket
+        subprocess.run(
+            ['ssh', '-o', f'ControlPath={sock}', '-O', 'exit', 'master'],
+            capture_output=True
+        )
+    shutil.rmtree(_ctl_dir, ignore_errors=True)
+
+
+atexit.register(close_masters)
+
+
+def _ssh_opts() -> list[str]:
+    return [
+        '-o', 'ControlMaster=auto',
+        '-o', f'ControlPath={_control_dir()}/%C',
+        '-o', 'ControlPersist=60s',
+    ]
+
+
+def _ssh(port: int) -> list[str]:
+    return ['ssh', '-p', str(port), *_ssh_opts()]
+
 
 def ssh_run(target: str, cmd: str, port: int = 22) -> None:
     result = subprocess.run(
-        ['ssh', '-p', str(port), target, cmd],
+        [*_ssh(port), target, cmd],
         capture_output=True, text=True
     )
     if result.returncode != 0:
@@ -13,33 +60,143 @@ def ssh_run(target: str, cmd: str, port: int = 22) -> None:
         sys.exit(1)
 
 
-def ssh_read_file(target: str, path: str, port: int = 22) -> str:
+def ssh_run_script(target: str, script: str, port: int = 22) -> None:
+    """Run a multi-command shell script in a single ssh session."""
     result = subprocess.run(
-        ['ssh', '-p', str(port), target, f'cat {path} 2>/dev/null || true'],
-        capture_output=True, text=True
+        [*_ssh(port), target, 'bash -s'],
+        input=script, capture_output=True, text=True
     )
-    return result.stdout
+    if result.returncode != 0:
+        print(f"  SSH error: {result.stderr.strip()}", file=sys.stderr)
+        sys.exit(1)
 
 
-def rsync_file(local: Path, target: str, remote: str, port: int = 22) -> bool:
+def ssh_sha256_many(target: str, paths: list[str], port: int = 22) -> dict[str, str]:
+    """Hex sha256 per remote path in one ssh call; missing files are omitted."""
     result = subprocess.run(
-        ['rsync', '-az', '--checksum', '--itemize-changes',
-         '-e', f'ssh -p {port}',
-         str(local), f'{target}:{remote}'],
+        [*_ssh(port), target,
+         f"sha256sum -- {' '.join(map(shlex.quote, paths))} 2>/dev/null || true"],
         capture_output=True, text=True
     )
-    for line in result.stdout.strip().splitlines():
-        # itemize format: YXcstpoguax
-        # [0]='<' sent, [2]='c' checksum differs, [3]='s' size differs, [8]='+' new file
-        # A truly unchanged file produces no output or dots-only flags
-        flags = line[1:11] if len(line) > 1 else ''
-        if line and line[0] in '<>' and ('c' in flags or 's' in flags or '+' in flags):
-            return True
-    return False
+    hashes = {}
+    for line in result.stdout.splitlines():
+        digest, _, path = line.partition('  ')
+        hashes[path] = digest
+    return hashes
+
+
+def ssh_read_files(target: str, paths: list[str], port: int = 22) -> dict[str, bytes]:
+    """Fetch several remote files in one ssh call; missing files read as b''."""
+    # Each file is framed as "<size>\n<bytes>" (size -1 if missing or
+    # unreadable), so arbitrary content can't be confused with a delimiter.
+    # The size is taken before anything is printed, so a failing wc can't
+    # leave a frame without its header
+    script = (
+        f"for f in {' '.join(map(shlex.quote, paths))}; do "
+        'if [ -f "$f" ] && [ -r "$f" ] && n=$(wc -c < "$f" 2>/dev/null); '
+        'then echo "$n"; cat -- "$f"; else echo -1; fi; '
+        'done'
+    )
+    result = subprocess.run([*_ssh(port), target, script], capture_output=True)
+    out, pos, files = result.stdout, 0, dict.fromkeys(paths, b'')
+    for path in paths:
+        nl = out.find(b'\n', pos)
+        if nl < 0:
+            break
+        try:
+            size = int(out[pos:nl])
+        except ValueError:
+            # Framing lost (e.g. a file changed size mid-read); later files
+            # can't be attributed reliably, so they read as empty
+            break
+        pos = nl + 1
+        if size >= 0:
+            files[path] = out[pos:pos + size]
+            pos += size
+    return files
+
+
+def _is_change(line: str) -> bool:
+    # itemize format: YXcstpoguax
+    # [0]='<'/'>' means file data was sent; without --checksum a same-size
+    # edit (a renewed cert, a re-rendered config) shows only 't'
+    # (e.g. '<f..t......'), so any send counts.
+    # Attribute-only updates start with '.', truly unchanged files print nothing
+    return bool(line) and line[0] in '<>'
+
+
+# Below this, the delta algorithm's rolling checksums cost more than just
+# sending the file
+WHOLE_FILE_MAX = 64 * 1024
+
+
+def _rsync_base(checksum: bool, force: bool = False,
+                locals_: list[Path] = ()) -> list[str]:
+    # rsync >= 3.2 already negotiates xxh128/xxh3 for --checksum when both
+    # ends support it; pinning --checksum-choice would break older remotes
+    args = ['rsync', '-az', '--itemize-changes']
+    if checksum:
+        args.append('--checksum')
+    if force:
+        args.append('--ignore-times')
+    try:
+        if locals_ and all(Path(p).stat().st_size < WHOLE_FILE_MAX for p in locals_):
+            args.append('--whole-file')
+    except OSError:
+        pass
+    return args
+
+
+def rsync_many(local_dir: Path, target: str, file_map: list[tuple[Path, str]],
+               port: int = 22, checksum: bool = False, force: bool = False,
+               setup_dirs: list[str] = ()) -> set[str]:
+    """Push several files to absolute remote paths in one rsync session.
+
+    local_dir is a staging tree mirroring the remote filesystem; files not
+    already at local_dir/<remote path> are copied there first. Returns the
+    set of remote paths that changed. By default rsync's size+mtime quick
+    check decides what to send, so local mtimes must be stable for unchanged
+    content (see lib.deploy._stamp); checksum=True compares contents instead
+    and force=True (--ignore-times) resends everything. setup_dirs are
+    created remotely inside the same session, before the receiver starts.
+    """
+    relpaths, staged_files = [], []
+    for local, remote in file_map:
+        rel = remote.lstrip('/')
+        staged = local_dir / rel
+        if Path(local).resolve() != staged.resolve():
+            staged.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(local, staged)
+        relpaths.append(rel)
+        staged_files.append(staged)
+
+    # --no-implied-dirs keeps rsync from stamping staging dir attributes
+    # onto existing remote parents like /etc
+    rsync_path = (['--rsync-path', f"mkdir -p {' '.join(setup_dirs)} && rsync"]
+                  if setup_dirs else [])
+    result = subprocess.run(
+        [*_rsync_base(checksum, force, staged_files),
+         '--no-implied-dirs', '--files-from=-', *rsync_path,
+         '-e', ' '.join(_ssh(port)),
+         f'{local_dir}/', f'{target}:/'],
+        input='\n'.join(relpaths) + '\n', capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        print(f"  rsync error: {result.stderr.strip()}", file=sys.stderr)
+        sys.exit(1)
+
+    return {'/' + line.split(' ', 1)[1] for line in result.stdout.strip().splitlines()
+            if _is_change(line) and line[1] == 'f'}
 
 
 def write_secret_remote(target: str, content: str, path: str, port: int = 22) -> None:
+    # umask makes the temp file 0600 from creation; it takes over the
+    # existing file's owner (services may read it as a non-root uid)
+    # before mv swaps it in atomically
+    q, tmp = shlex.quote(path), shlex.quote(f'{path}.tmp')
     subprocess.run(
-        ['ssh', '-p', str(port), target, f'cat > {path} && chmod 600 {path}'],
+        [*_ssh(port), target,
+         f'umask 077; cat > {tmp} && {{ [ ! -e {q} ] || chown --reference={q} {tmp}; }}'
+         f' && mv -f {tmp} {q} || {{ rm -f {tmp}; exit 1; }}'],
         input=content, text=True, check=True
     )
@@ -0,0 +1,92 @@
+"""In-process SSH via asyncssh, for fan-out to many hosts.
+
+Optional and opt-in: callers import it only when asked to, and catch
+ImportError. Failures are printed and raised as RemoteError instead of
+exiting, so one host's error can't cancel the coroutines still working on
+other hosts. Host keys are checked against ~/.ssh/known_hosts and auth uses
+~/.ssh/config and the running ssh-agent, as with the ssh binary.
+"""
+import asyncio
+import hashlib
+import shlex
+import sys
+from pathlib import Path
+
+import asyncssh
+
+
+class RemoteError(Exception):
+    """A remote command, upload or connection failed; already reported."""
+
+
+# One connection per (target, port), shared by every coroutine in the loop
+_conns: dict[tuple[str, int], asyncio.Future] = {}
+
+
+async def _connect(target: str, port: int) -> asyncssh.SSHClientConnection:
+    key = (target, port)
+    if key not in _conns:
+        user, _, host = target.rpartition('@')
+        _conns[key] = asyncio.ensure_future(
+            asyncssh.connect(host, port=port, username=user or None)
+        )
+    try:
+        return await _conns[key]
+    except (OSError, asyncssh.Error) as e:
+        print(f"  SSH error: {target}: {e}", file=sys.stderr)
+        raise RemoteError(str(e)) from e
+
+
+async def run(target: str, cmd: str, port: int = 22) -> str:
+    conn = await _connect(target, port)
+    try:
+        result = await conn.run(cmd, check=False)
+    except (OSError, asyncssh.Error) as e:
+        print(f"  SSH error: {target}: {e}", file=sys.stderr)
+        raise RemoteError(str(e)) from e
+    if result.exit_status != 0:
+        print(f"  SSH error: {str(result.stderr).strip()}", file=sys.stderr)
+        raise RemoteError(str(result.stderr).strip())
+    return result.stdout
+
+
+async def put(target: str, local: Path, remote: str, port: int = 22) -> bool:
+    """Upload local to remote unless contents already match; True if sent."""
+    data = Path(local).read_bytes()
+    remote_hash = await run(
+        target, f"sha256sum -- {shlex.quote(remote)} 2>/dev/null | cut -d' ' -f1", port
+    )
+    if remote_hash.strip() == hashlib.sha256(data).hexdigest():
+        return False
+    st = Path(local).stat()
+    tmp = f'{remote}.tmp'
+    conn = await _connect(target, port)
+    try:
+        async with conn.start_sftp_client() as sftp:
+            # Written 0600 under a temp name, then renamed over the target: a
+            # key is never readable with default perms, nor visible half-written
+            try:
+                async with sftp.open(tmp, 'wb', asyncssh.SFTPAttrs(permissions=0o600)) as f:
+                    await f.write(data)
+                await sftp.setstat(tmp, asyncssh.SFTPAttrs(
+                    permissions=st.st_mode & 0o777,
+                    atime=int(st.st_atime), mtime=int(st.st_mtime)))
+                await sftp.posix_rename(tmp, remote)
+            except (OSError, asyncssh.Error):
+                try:
+                    await sftp.remove(tmp)
+                except (OSError, asyncssh.Error):
+                    pass
+                raise
+    except (OSError, asyncssh.Error) as e:
+        print(f"  SSH error: {target}: {remote}: {e}", file=sys.stderr)
+        raise RemoteError(str(e)) from e
+    return True
+
+
+async def close_all() -> None:
+    for fut in _conns.values():
+        if fut.done() and not fut.cancelled() and not fut.exception():
+            fut.result().close()
+            await fut.result().wait_closed()
+    _conns.clear()
@@ -1,19 +1,137 @@
+import copy
+import functools
+import hashlib
+import os
 import subprocess
 import sys
+import tempfile
+import time
 from pathlib import Path
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+    print("warning: PyYAML built without libyaml, falling back to the "
+          "pure-Python loader", file=sys.stderr)
+
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'infra-sops'
+
+
+def _cache_ttl(default: int = 60) -> int:
+    try:
+        return int(os.environ.get('SOPS_CACHE_TTL', default))
+    except ValueError:
+        print(f"warning: invalid SOPS_CACHE_TTL, using {default}s", file=sys.stderr)
+        return default
+
+
+CACHE_TTL = _cache_ttl()
+
+
+def _cache_file(file_path: Path) -> Path | None:
+    """Plaintext cache location keyed by ciphertext hash, None if disabled."""
+    if os.environ.get('INFRA_SOPS_NOCACHE') == '1' or CACHE_TTL <= 0:
+        return None
+    try:
+        key = hashlib.sha256(file_path.read_bytes()).hexdigest()
+    except OSError:
+        return None
+    return CACHE_DIR / f'{key}.yaml'
+
+
+def _expired(path: Path) -> bool:
+    return time.time() - os.stat(path).st_mtime > CACHE_TTL
+
+
+def _read_cache(cache: Path) -> bytes | None:
+    try:
+        if _expired(cache):
+            # Expired plaintext is only removed when a later run reads or
+            # writes the cache; nothing deletes it between runs
+            cache.unlink(missing_ok=True)
+            return None
+        return cache.read_bytes()
+    except OSError:
+        return None
+
+
+def _prune_cache(keep: Path) -> None:
+    """Delete expired plaintext left behind by older ciphertext versions."""
+    for path in CACHE_DIR.glob('*.yaml'):
+        try:
+            if path != keep and _expired(path):
+                path.unlink()
+        except OSError:
+            pass
+
+
+def _write_cache(cache: Path, plaintext: bytes) -> None:
+    try:
+        CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        fd = os.open(cache, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(plaintext)
+        _prune_cache(cache)
+    except OSError:
+        pass
+
 
 def decrypt_sops(file_path: Path) -> dict:
+    if os.environ.get('INFRA_SOPS_NOCACHE') == '1':
+        return _decrypt(file_path)
     try:
-        result = subprocess.run(
-            ['sops', '-d', str(file_path)],
-            capture_output=True, text=True, check=True
-        )
-        return yaml.safe_load(result.stdout)
-    except subprocess.CalledProcessError as e:
-        print(f"SOPS decryption error: {e.stderr}", file=sys.stderr)
-        sys.exit(1)
-    except FileNotFoundError:
-        print("sops not found in PATH", file=sys.stderr)
-        sys.exit(1)
+        key = (str(file_path.resolve()), file_path.stat().st_mtime_ns)
+    except OSError:
+        return _decrypt(file_path)
+    # Callers get their own copy so mutations can't leak into the memo
+    return copy.deepcopy(_decrypt_memo(key))
+
+
+@functools.lru_cache(maxsize=16)
+def _decrypt_memo(key: tuple[str, int]) -> dict:
+    return _decrypt(Path(key[0]))
+
+
+def _decrypt(file_path: Path) -> dict:
+    cache = _cache_file(file_path)
+    if cache:
+        plaintext = _read_cache(cache)
+        if plaintext is not None:
+            return yaml.load(plaintext, Loader=SafeLoader)
+
+    # stderr goes to a file, not a pipe, so a chatty sops can't deadlock us
+    with tempfile.TemporaryFile() as err:
+        try:
+            proc = subprocess.Popen(
+                ['sops', '-d', str(file_path)],
+                stdout=subprocess.PIPE, stderr=err
+            )
+        except FileNotFoundError:
+            print("sops not found in PATH", file=sys.stderr)
+            sys.exit(1)
+
+        data = plaintext = None
+        parse_error = None
+        with proc.stdout:
+            try:
+                if cache:
+                    plaintext = proc.stdout.read()
+                    data = yaml.load(plaintext, Loader=SafeLoader)
+                else:
+                    data = yaml.load(proc.stdout, Loader=SafeLoader)
+            except yaml.YAMLError as e:
+                parse_error = e
+
+        if proc.wait() != 0:
+            err.seek(0)
+            print(f"SOPS decryption error: {err.read().decode('utf-8', 'replace')}",
+                  file=sys.stderr)
+            sys.exit(1)
+
+    if parse_error:
+        raise parse_error
+    if cache:
+        _write_cache(cache, plaintext)
+    return data
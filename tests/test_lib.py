@@ -1,5 +1,8 @@
 """Tests for lib/ — pure logic + mocked externals."""
 
+import io
+import os
+import shutil
 import subprocess
 import sys
 from pathlib import Path
@@ -61,50 +64,184 @@ class TestJinja:
         assert result == "localhost:5432"
 
 
+    def test_bytecode_cache_no_reload(self, tmp_path):
+        from jinja2 import FileSystemBytecodeCache
+        from lib.jinja import create_jinja_env
+        env = create_jinja_env(tmp_path)
+        assert isinstance(env.bytecode_cache, FileSystemBytecodeCache)
+        assert env.auto_reload is False
+
+    def test_jinja2_imported_lazily(self):
+        # `deploy.py list` never renders, so importing lib.deploy must not pull in jinja2
+        code = "import sys, lib.deploy; print('jinja2' in sys.modules)"
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                             cwd=Path(__file__).resolve().parent.parent, check=True)
+        assert out.stdout.strip() == "False"
+
+
 # ═══════════════════════════════════════════════════
 # lib/sops.py
 # ═══════════════════════════════════════════════════
 
 
+def _fake_sops(stdout=b"", returncode=0, stderr=b""):
+    """Popen stand-in for `sops -d`: stdout pipe + stderr written to the sink."""
+    out, err = stdout, stderr
+
+    def popen(args, stdout=None, stderr=None):
+        stderr.write(err)
+        return MagicMock(stdout=io.BytesIO(out), wait=MagicMock(return_value=returncode))
+    return MagicMock(side_effect=popen)
+
+
 class TestSops:
-    @patch("subprocess.run")
-    def test_decrypt_success(self, mock_run):
-        mock_run.return_value = MagicMock(
-            stdout="key: value\nlist:\n  - a\n  - b\n", returncode=0
-        )
-        from lib.sops import decrypt_sops
-        result = decrypt_sops(Path("/fake/secrets.enc.yaml"))
+    @pytest.fixture(autouse=True)
+    def _clear_memo(self):
+        from lib.sops import _decrypt_memo
+        _decrypt_memo.cache_clear()
+        yield
+        _decrypt_memo.cache_clear()
+
+    def test_decrypt_success(self, monkeypatch):
+        monkeypatch.setenv("INFRA_SOPS_NOCACHE", "1")
+        fake = _fake_sops(b"key: value\nlist:\n  - a\n  - b\n")
+        with patch("subprocess.Popen", fake):
+            from lib.sops import decrypt_sops
+            result = decrypt_sops(Path("/fake/secrets.enc.yaml"))
         assert result == {"key": "value", "list": ["a", "b"]}
-        mock_run.assert_called_once_with(
-            ["sops", "-d", "/fake/secrets.enc.yaml"],
-            capture_output=True, text=True, check=True,
-        )
+        assert fake.call_args[0][0] == ["sops", "-d", "/fake/secrets.enc.yaml"]
+        assert fake.call_args.kwargs["stdout"] == subprocess.PIPE
 
-    @patch("subprocess.run")
-    def test_decrypt_nested_yaml(self, mock_run):
-        mock_run.return_value = MagicMock(
-            stdout="db:\n  host: localhost\n  port: 5432\n", returncode=0
-        )
-        from lib.sops import decrypt_sops
-        result = decrypt_sops(Path("/fake/s.yaml"))
+    def test_decrypt_nested_yaml(self):
+        with patch("subprocess.Popen", _fake_sops(b"db:\n  host: localhost\n  port: 5432\n")):
+            from lib.sops import decrypt_sops
+            result = decrypt_sops(Path("/fake/s.yaml"))
         assert result["db"]["host"] == "localhost"
         assert result["db"]["port"] == 5432
 
-    @patch(
-        "subprocess.run",
-        side_effect=subprocess.CalledProcessError(1, "sops", stderr="bad"),
-    )
-    def test_decrypt_failure_exits(self, mock_run):
-        from lib.sops import decrypt_sops
-        with pytest.raises(SystemExit):
-            decrypt_sops(Path("/fake/secrets.enc.yaml"))
+    def test_decrypt_failure_exits(self, capsys):
+        with patch("subprocess.Popen", _fake_sops(returncode=1, stderr=b"bad key")):
+            from lib.sops import decrypt_sops
+            with pytest.raises(SystemExit):
+                decrypt_sops(Path("/fake/secrets.enc.yaml"))
+        assert "bad key" in capsys.readouterr().err
 
-    @patch("subprocess.run", side_effect=FileNotFoundError)
-    def test_sops_not_found_exits(self, mock_run):
+    @patch("subprocess.Popen", side_effect=FileNotFoundError)
+    def test_sops_not_found_exits(self, mock_popen):
         from lib.sops import decrypt_sops
         with pytest.raises(SystemExit):
             decrypt_sops(Path("/fake/secrets.enc.yaml"))
 
+    @pytest.mark.skipif(not hasattr(__import__("yaml"), "CSafeLoader"),
+                        reason="PyYAML built without libyaml")
+    def test_uses_libyaml_loader(self):
+        import yaml
+        from lib.sops import SafeLoader
+        assert SafeLoader is yaml.CSafeLoader
+
+    def test_cache_hit_skips_sops(self, tmp_path, monkeypatch):
+        import lib.sops
+        monkeypatch.setattr(lib.sops, "CACHE_DIR", tmp_path / "cache")
+        monkeypatch.delenv("INFRA_SOPS_NOCACHE", raising=False)
+        enc = tmp_path / "s.enc.yaml"
+        enc.write_text("ciphertext")
+        mock_run = _fake_sops(b"key: value\n")
+        monkeypatch.setattr(subprocess, "Popen", mock_run)
+        assert lib.sops.decrypt_sops(enc) == {"key": "value"}
+        lib.sops._decrypt_memo.cache_clear()  # simulate a fresh process
+        assert lib.sops.decrypt_sops(enc) == {"key": "value"}
+        assert mock_run.call_count == 1
+        cached = next((tmp_path / "cache").iterdir())
+        assert cached.stat().st_mode & 0o777 == 0o600
+
+    def test_cache_invalidated_by_ciphertext_change(self, tmp_path, monkeypatch):
+        import lib.sops
+        monkeypatch.setattr(lib.sops, "CACHE_DIR", tmp_path / "cache")
+        monkeypatch.delenv("INFRA_SOPS_NOCACHE", raising=False)
+        enc = tmp_path / "s.enc.yaml"
+        enc.write_text("v1")
+        mock_run = _fake_sops(b"key: a\n")
+        monkeypatch.setattr(subprocess, "Popen", mock_run)
+        lib.sops.decrypt_sops(enc)
+        enc.write_text("v2")
+        mock_run = _fake_sops(b"key: b\n")
+        monkeypatch.setattr(subprocess, "Popen", mock_run)
+        assert lib.sops.decrypt_sops(enc) == {"key": "b"}
+        assert mock_run.call_count == 1
+
+    def test_cache_expired(self, tmp_path, monkeypatch):
+        import lib.sops
+        monkeypatch.setattr(lib.sops, "CACHE_DIR", tmp_path / "cache")
+        monkeypatch.setattr(lib.sops, "CACHE_TTL", 60)
+        monkeypatch.delenv("INFRA_SOPS_NOCACHE", raising=False)
+        enc = tmp_path / "s.enc.yaml"
+        enc.write_text("ciphertext")
+        mock_run = _fake_sops(b"key: value\n")
+        monkeypatch.setattr(subprocess, "Popen", mock_run)
+        lib.sops.decrypt_sops(enc)
+        cached = next((tmp_path / "cache").iterdir())
+        os.utime(cached, (0, 0))
+        lib.sops._decrypt_memo.cache_clear()
+        monkeypatch.setattr(lib.sops, "_write_cache", lambda cache, data: None)
+        lib.sops.decrypt_sops(enc)
+        assert mock_run.call_count == 2
+        # the stale plaintext is removed, not just ignored
+        assert not cached.exists()
+
+    def test_cache_write_prunes_expired(self, tmp_path, monkeypatch):
+        import lib.sops
+        cache_dir = tmp_path / "cache"
+        monkeypatch.setattr(lib.sops, "CACHE_DIR", cache_dir)
+        monkeypatch.setattr(lib.sops, "CACHE_TTL", 60)
+        monkeypatch.delenv("INFRA_SOPS_NOCACHE", raising=False)
+        cache_dir.mkdir()
+        stale, fresh = cache_dir / "old.yaml", cache_dir / "recent.yaml"
+        stale.write_text("old: secret\n")
+        fresh.write_text("recent: secret\n")
+        os.utime(stale, (0, 0))
+        enc = tmp_path / "s.enc.yaml"
+        enc.write_text("ciphertext")
+        monkeypatch.setattr(subprocess, "Popen", _fake_sops(b"key: value\n"))
+        lib.sops.decrypt_sops(enc)
+        assert not stale.exists()
+        assert fresh.exists()
+        assert len(list(cache_dir.iterdir())) == 2
+
+    def test_invalid_cache_ttl_env(self, monkeypatch, capsys):
+        import lib.sops
+        monkeypatch.setenv("SOPS_CACHE_TTL", "1m")
+        assert lib.sops._cache_ttl() == 60
+        assert "SOPS_CACHE_TTL" in capsys.readouterr().err
+        monkeypatch.setenv("SOPS_CACHE_TTL", "5")
+        assert lib.sops._cache_ttl() == 5
+
+    def test_memoized_in_process(self, tmp_path, monkeypatch):
+        import lib.sops
+        monkeypatch.setattr(lib.sops, "CACHE_DIR", tmp_path / "cache")
+        monkeypatch.delenv("INFRA_SOPS_NOCACHE", raising=False)
+        enc = tmp_path / "s.enc.yaml"
+        enc.write_text("ciphertext")
+        mock_run = _fake_sops(b"key: value\n")
+        monkeypatch.setattr(subprocess, "Popen", mock_run)
+        first = lib.sops.decrypt_sops(enc)
+        first["key"] = "mutated"
+        shutil.rmtree(tmp_path / "cache")
+        assert lib.sops.decrypt_sops(enc) == {"key": "value"}
+        assert mock_run.call_count == 1
+
+    def test_nocache_env(self, tmp_path, monkeypatch):
+        import lib.sops
+        monkeypatch.setattr(lib.sops, "CACHE_DIR", tmp_path / "cache")
+        monkeypatch.setenv("INFRA_SOPS_NOCACHE", "1")
+        enc = tmp_path / "s.enc.yaml"
+        enc.write_text("ciphertext")
+        mock_run = _fake_sops(b"key: value\n")
+        monkeypatch.setattr(subprocess, "Popen", mock_run)
+        lib.sops.decrypt_sops(enc)
+        lib.sops.decrypt_sops(enc)
+        assert mock_run.call_count == 2
+        assert not (tmp_path / "cache").exists()
+
 
 # ═══════════════════════════════════════════════════
 # lib/remote.py
@@ -115,13 +252,62 @@ class TestRemote:
     @patch("subprocess.run")
     def test_ssh_run_success(self, mock_run):
         mock_run.return_value = MagicMock(returncode=0, stderr="")
-        from lib.remote import ssh_run
+        from lib.remote import ssh_run, _ssh_opts
         ssh_run("user@host", "echo hi", port=2222)
         mock_run.assert_called_once_with(
-            ["ssh", "-p", "2222", "user@host", "echo hi"],
+            ["ssh", "-p", "2222", *_ssh_opts(), "user@host", "echo hi"],
             capture_output=True, text=True,
         )
 
+    @patch("subprocess.run")
+    def test_ssh_run_uses_control_master(self, mock_run):
+        mock_run.return_value = MagicMock(returncode=0, stderr="")
+        from lib.remote import ssh_run
+        ssh_run("user@host", "ls")
+        args = mock_run.call_args[0][0]
+        assert "ControlMaster=auto" in args
+        assert any(a.startswith("ControlPath=") for a in args)
+
+    @patch("subprocess.run")
+    def test_close_masters(self, mock_run, tmp_path, monkeypatch):
+        import lib.remote
+        ctl = tmp_path / "ctl"
+        ctl.mkdir()
+        (ctl / "abc123").touch()
+        monkeypatch.setattr(lib.remote, "_ctl_dir", str(ctl))
+        lib.remote.close_masters()
+        args = mock_run.call_args[0][0]
+        assert args[:3] == ["ssh", "-o", f"ControlPath={ctl / 'abc123'}"]
+        assert "-O" in args and "exit" in args
+        assert not ctl.exists()
+
+    @patch("subprocess.run")
+    def test_control_dir_created_lazily(self, mock_run, monkeypatch):
+        import lib.remote
+        monkeypatch.setattr(lib.remote, "_ctl_dir", None)
+        lib.remote.close_masters()
+        mock_run.assert_not_called()
+        ctl = lib.remote._control_dir()
+        try:
+            assert Path(ctl).is_dir()
+            assert lib.remote._control_dir() == ctl
+        finally:
+            lib.remote.close_masters()
+        assert not Path(ctl).exists()
+
+    @patch("subprocess.run")
+    def test_rsync_shares_control_path(self, mock_run, tmp_path):
+        mock_run.return_value = MagicMock(stdout="", returncode=0)
+        (tmp_path / "f").write_text("x")
+        import lib.remote
+        from lib.remote import rsync_many
+        rsync_many(tmp_path, "user@host", [(tmp_path / "f", "/etc/f")], 2222)
+        _ctl_dir = lib.remote._ctl_dir
+        args = mock_run.call_args[0][0]
+        ssh_cmd = args[args.index("-e") + 1]
+        assert ssh_cmd.startswith("ssh -p 2222 ")
+        assert f"ControlPath={_ctl_dir}/%C" in ssh_cmd
+
     @patch("subprocess.run")
     def test_ssh_run_default_port(self, mock_run):
         mock_run.return_value = MagicMock(returncode=0, stderr="")
@@ -138,48 +324,176 @@ class TestRemote:
             ssh_run("user@host", "fail")
 
     @patch("subprocess.run")
-    def test_ssh_read_file(self, mock_run):
-        mock_run.return_value = MagicMock(stdout="file content\n")
-        from lib.remote import ssh_read_file
-        assert ssh_read_file("user@host", "/etc/conf", port=22) == "file content\n"
+    def test_ssh_run_script(self, mock_run):
+        mock_run.return_value = MagicMock(returncode=0, stderr="")
+        from lib.remote import ssh_run_script
+        ssh_run_script("user@host", "set -e\nchmod 600 /etc/k\n", 22)
+        assert mock_run.call_args[0][0][-2:] == ["user@host", "bash -s"]
+        assert mock_run.call_args.kwargs["input"] == "set -e\nchmod 600 /etc/k\n"
 
     @patch("subprocess.run")
-    def test_ssh_read_file_missing_returns_empty(self, mock_run):
-        mock_run.return_value = MagicMock(stdout="")
-        from lib.remote import ssh_read_file
-        assert ssh_read_file("user@host", "/nonexistent") == ""
+    def test_ssh_run_script_failure_exits(self, mock_run):
+        mock_run.return_value = MagicMock(returncode=1, stderr="boom")
+        from lib.remote import ssh_run_script
+        with pytest.raises(SystemExit):
+            ssh_run_script("user@host", "false\n")
 
     @patch("subprocess.run")
-    def test_rsync_checksum_changed(self, mock_run):
-        mock_run.return_value = MagicMock(stdout="<fc.st...... file.conf\n", returncode=0)
-        from lib.remote import rsync_file
-        assert rsync_file(Path("/tmp/f"), "user@host", "/etc/f", 22) is True
+    def test_ssh_sha256_many(self, mock_run):
+        mock_run.return_value = MagicMock(stdout="aa  /etc/a\nbb  /etc/b c\n")
+        from lib.remote import ssh_sha256_many
+        hashes = ssh_sha256_many("user@host", ["/etc/a", "/etc/b c", "/etc/missing"])
+        assert hashes == {"/etc/a": "aa", "/etc/b c": "bb"}
+        assert mock_run.call_count == 1
+        assert "'/etc/b c'" in mock_run.call_args[0][0][-1]
 
     @patch("subprocess.run")
-    def test_rsync_size_changed(self, mock_run):
-        mock_run.return_value = MagicMock(stdout="<f..s....... file.conf\n", returncode=0)
-        from lib.remote import rsync_file
-        assert rsync_file(Path("/tmp/f"), "user@host", "/etc/f", 22) is True
+    def test_ssh_read_files_framing(self, mock_run):
+        mock_run.return_value = MagicMock(stdout=b"3\nabc-1\n      5\n1\n\n2\n")
+        from lib.remote import ssh_read_files
+        files = ssh_read_files("user@host", ["/a", "/missing", "/b"])
+        assert files == {"/a": b"abc", "/missing": b"", "/b": b"1\n\n2\n"}
+        assert mock_run.call_count == 1
+        assert "text" not in mock_run.call_args.kwargs
 
     @patch("subprocess.run")
-    def test_rsync_unchanged(self, mock_run):
-        mock_run.return_value = MagicMock(stdout="", returncode=0)
-        from lib.remote import rsync_file
-        assert rsync_file(Path("/tmp/f"), "user@host", "/etc/f", 22) is False
+    def test_ssh_read_files_bad_framing(self, mock_run):
+        # a frame that lost its size header must not raise or shift later files
+        mock_run.return_value = MagicMock(stdout=b"3\nabcnot a size\n2\nxy")
+        from lib.remote import ssh_read_files
+        files = ssh_read_files("user@host", ["/a", "/b", "/c"])
+        assert files == {"/a": b"abc", "/b": b"", "/c": b""}
+
+    def test_ssh_read_files_unreadable(self, tmp_path):
+        # run the generated loop locally: an unreadable file frames as -1
+        if os.geteuid() == 0:
+            pytest.skip("root can read any file")
+        (tmp_path / "a").write_text("abc")
+        (tmp_path / "secret").write_text("s")
+        (tmp_path / "secret").chmod(0)
+        (tmp_path / "b").write_text("b\n")
+        paths = [str(tmp_path / n) for n in ("a", "secret", "missing", "b")]
+        from lib.remote import ssh_read_files
+        with patch("subprocess.run", return_value=MagicMock(stdout=b"")) as mock_run:
+            ssh_read_files("user@host", paths)
+        script = mock_run.call_args[0][0][-1]
+        out = subprocess.run(["sh", "-c", script], capture_output=True).stdout
+        assert out == b"3\nabc-1\n-1\n2\nb\n"
+
+    def _itemize(self, mock_run, tmp_path, stdout):
+        mock_run.return_value = MagicMock(stdout=stdout, returncode=0)
+        (tmp_path / "f").write_text("x")
+        from lib.remote import rsync_many
+        return rsync_many(tmp_path, "user@host", [(tmp_path / "f", "/file.conf")], 22)
+
+    @patch("subprocess.run")
+    def test_rsync_checksum_changed(self, mock_run, tmp_path):
+        assert self._itemize(mock_run, tmp_path, "<fc.st...... file.conf\n") == {"/file.conf"}
 
     @patch("subprocess.run")
-    def test_rsync_dots_only_unchanged(self, mock_run):
+    def test_rsync_size_changed(self, mock_run, tmp_path):
+        assert self._itemize(mock_run, tmp_path, "<f..s....... file.conf\n") == {"/file.conf"}
+
+    @patch("subprocess.run")
+    def test_rsync_same_size_changed(self, mock_run, tmp_path):
+        # without --checksum (e.g. a renewed cert of the same size) the
+        # send is itemized with only the 't' flag
+        assert self._itemize(mock_run, tmp_path, "<f..t...... file.conf\n") == {"/file.conf"}
+        assert "--checksum" not in mock_run.call_args[0][0]
+
+    @patch("subprocess.run")
+    def test_rsync_unchanged(self, mock_run, tmp_path):
+        assert self._itemize(mock_run, tmp_path, "") == set()
+
+    @patch("subprocess.run")
+    def test_rsync_dots_only_unchanged(self, mock_run, tmp_path):
         # rsync emits dots-only flags for timestamp-only diffs — not a real change
-        mock_run.return_value = MagicMock(stdout=".f..t...... file.conf\n", returncode=0)
-        from lib.remote import rsync_file
-        assert rsync_file(Path("/tmp/f"), "user@host", "/etc/f", 22) is False
+        assert self._itemize(mock_run, tmp_path, ".f..t...... file.conf\n") == set()
 
     @patch("subprocess.run")
-    def test_rsync_new_file_on_remote(self, mock_run):
+    def test_rsync_new_file_on_remote(self, mock_run, tmp_path):
         # rsync emits '+' when file doesn't exist on remote yet
-        mock_run.return_value = MagicMock(stdout="<f+++++++++ file.conf\n", returncode=0)
-        from lib.remote import rsync_file
-        assert rsync_file(Path("/tmp/f"), "user@host", "/etc/f", 22) is True
+        assert self._itemize(mock_run, tmp_path, "<f+++++++++ file.conf\n") == {"/file.conf"}
+
+    @patch("subprocess.run")
+    def test_rsync_many_single_session(self, mock_run, tmp_path):
+        mock_run.return_value = MagicMock(
+            stdout="<f+++++++++ etc/containers/systemd/a.container\n"
+                   "cd+++++++++ opt/svc/\n"
+                   ".f..t...... opt/svc/b.yml\n",
+            returncode=0,
+        )
+        src = tmp_path / "src"
+        src.mkdir()
+        (src / "a").write_text("a")
+        (src / "b").write_text("b")
+        staging = tmp_path / "staging"
+        from lib.remote import rsync_many
+        changed = rsync_many(staging, "user@host", [
+            (src / "a", "/etc/containers/systemd/a.container"),
+            (src / "b", "/opt/svc/b.yml"),
+        ], 22)
+        assert changed == {"/etc/containers/systemd/a.container"}
+        assert mock_run.call_count == 1
+        args = mock_run.call_args[0][0]
+        assert "--files-from=-" in args
+        assert args[-1] == "user@host:/"
+        assert mock_run.call_args.kwargs["input"] == (
+            "etc/containers/systemd/a.container\nopt/svc/b.yml\n"
+        )
+        assert (staging / "opt/svc/b.yml").read_text() == "b"
+
+    @patch("subprocess.run")
+    def test_rsync_checksum_optional(self, mock_run, tmp_path):
+        mock_run.return_value = MagicMock(stdout="", returncode=0)
+        (tmp_path / "f").write_text("x")
+        from lib.remote import rsync_many
+        rsync_many(tmp_path, "user@host", [(tmp_path / "f", "/f")], 22)
+        assert "--checksum" not in mock_run.call_args[0][0]
+        rsync_many(tmp_path, "user@host", [(tmp_path / "f", "/f")], 22, checksum=True)
+        assert "--checksum" in mock_run.call_args[0][0]
+
+    @patch("subprocess.run")
+    def test_rsync_force_ignores_times(self, mock_run, tmp_path):
+        mock_run.return_value = MagicMock(stdout="", returncode=0)
+        (tmp_path / "f").write_text("x")
+        from lib.remote import rsync_many
+        rsync_many(tmp_path, "user@host", [(tmp_path / "f", "/f")], 22)
+        assert "--ignore-times" not in mock_run.call_args[0][0]
+        rsync_many(tmp_path, "user@host", [(tmp_path / "f", "/f")], 22, force=True)
+        assert "--ignore-times" in mock_run.call_args[0][0]
+
+    @patch("subprocess.run")
+    def test_rsync_many_setup_dirs(self, mock_run, tmp_path):
+        mock_run.return_value = MagicMock(stdout="", returncode=0)
+        (tmp_path / "f").write_text("x")
+        from lib.remote import rsync_many
+        rsync_many(tmp_path, "user@host", [(tmp_path / "f", "/opt/a/f")], 22)
+        assert "--rsync-path" not in mock_run.call_args[0][0]
+        rsync_many(tmp_path, "user@host", [(tmp_path / "f", "/opt/a/f")], 22,
+                   setup_dirs=["/opt/a", "/opt/b"])
+        args = mock_run.call_args[0][0]
+        assert args[args.index("--rsync-path") + 1] == "mkdir -p /opt/a /opt/b && rsync"
+
+    @patch("subprocess.run")
+    def test_rsync_whole_file_for_small_files(self, mock_run, tmp_path):
+        mock_run.return_value = MagicMock(stdout="", returncode=0)
+        (tmp_path / "small").write_text("x")
+        (tmp_path / "big").write_bytes(b"x" * (64 * 1024))
+        from lib.remote import rsync_many
+        rsync_many(tmp_path / "s", "user@host", [(tmp_path / "small", "/a")], 22)
+        assert "--whole-file" in mock_run.call_args[0][0]
+        rsync_many(tmp_path / "s", "user@host",
+                   [(tmp_path / "small", "/a"), (tmp_path / "big", "/b")], 22)
+        assert "--whole-file" not in mock_run.call_args[0][0]
+
+    @patch("subprocess.run")
+    def test_rsync_many_failure_exits(self, mock_run, tmp_path):
+        mock_run.return_value = MagicMock(stdout="", stderr="denied", returncode=23)
+        (tmp_path / "f").write_text("x")
+        from lib.remote import rsync_many
+        with pytest.raises(SystemExit):
+            rsync_many(tmp_path, "user@host", [(tmp_path / "f", "/f")], 22)
 
     @patch("subprocess.run")
     def test_write_secret_remote(self, mock_run):
@@ -189,6 +503,174 @@ class TestRemote:
         call_kw = mock_run.call_args
         assert call_kw.kwargs["input"] == "secret_data"
         assert call_kw.kwargs["check"] is True
+        cmd = call_kw[0][0][-1]
+        assert cmd.startswith("umask 077; cat > /etc/key.tmp && ")
+        assert "chown --reference=/etc/key /etc/key.tmp" in cmd
+        assert cmd.index("chown") < cmd.index("mv -f /etc/key.tmp /etc/key")
+        assert cmd.endswith("|| { rm -f /etc/key.tmp; exit 1; }")
+
+    def test_write_secret_remote_shell(self, tmp_path):
+        # run the generated command locally: owner kept, mode 0600, no leftovers
+        from lib.remote import write_secret_remote
+        key = tmp_path / "k"
+        key.write_text("old")
+        with patch("subprocess.run") as mock_run:
+            write_secret_remote("user@host", "new", str(key), 22)
+        cmd = mock_run.call_args[0][0][-1]
+        subprocess.run(["bash", "-c", cmd], input="new", text=True, check=True)
+        assert key.read_text() == "new"
+        assert key.stat().st_mode & 0o777 == 0o600
+        assert key.stat().st_uid == os.getuid()
+        assert not (tmp_path / "k.tmp").exists()
+
+
+# ═══════════════════════════════════════════════════
+# lib/remote_async.py (optional, needs asyncssh)
+# ═══════════════════════════════════════════════════
+
+
+class TestRemoteAsync:
+    @pytest.fixture
+    def ra(self):
+        pytest.importorskip("asyncssh")
+        import lib.remote_async as ra
+        ra._conns.clear()
+        yield ra
+        ra._conns.clear()
+
+    def _conn(self, stdout="", exit_status=0):
+        from unittest.mock import AsyncMock
+        conn = MagicMock()
+        conn.run = AsyncMock(return_value=MagicMock(stdout=stdout, stderr="", exit_status=exit_status))
+        sftp = MagicMock()
+        sftp.file = MagicMock()
+        sftp.file.write = AsyncMock()
+        sftp.file.__aenter__ = AsyncMock(return_value=sftp.file)
+        sftp.file.__aexit__ = AsyncMock(return_value=False)
+        sftp.open = MagicMock(return_value=sftp.file)
+        for name in ("setstat", "posix_rename", "remove"):
+            setattr(sftp, name, AsyncMock())
+        sftp.__aenter__ = AsyncMock(return_value=sftp)
+        sftp.__aexit__ = AsyncMock(return_value=False)
+        conn.start_sftp_client = MagicMock(return_value=sftp)
+        return conn, sftp
+
+    def test_connection_reused(self, ra):
+        import asyncio
+        from unittest.mock import AsyncMock
+        conn, _ = self._conn()
+        with patch("asyncssh.connect", AsyncMock(return_value=conn)) as mock_connect:
+            async def go():
+                await asyncio.gather(ra.run("admin@h", "a", 2222), ra.run("admin@h", "b", 2222))
+            asyncio.run(go())
+        mock_connect.assert_called_once_with("h", port=2222, username="admin")
+        assert conn.run.call_count == 2
+
+    def test_run_failure_raises(self, ra):
+        import asyncio
+        from unittest.mock import AsyncMock
+        conn, _ = self._conn(exit_status=1)
+        with patch("asyncssh.connect", AsyncMock(return_value=conn)):
+            with pytest.raises(ra.RemoteError):
+                asyncio.run(ra.run("h", "false"))
+
+    def test_connect_failure_raises(self, ra, capsys):
+        import asyncio
+        from unittest.mock import AsyncMock
+        with patch("asyncssh.connect", AsyncMock(side_effect=OSError("refused"))):
+            with pytest.raises(ra.RemoteError):
+                asyncio.run(ra.run("admin@h", "true"))
+        assert "SSH error: admin@h: refused" in capsys.readouterr().err
+
+    def test_put_quotes_remote_path(self, ra, tmp_path):
+        import asyncio
+        import hashlib
+        from unittest.mock import AsyncMock
+        (tmp_path / "c").write_bytes(b"cert")
+        conn, _ = self._conn(stdout=hashlib.sha256(b"cert").hexdigest() + "\n")
+        with patch("asyncssh.connect", AsyncMock(return_value=conn)):
+            asyncio.run(ra.put("h", tmp_path / "c", "/etc/a b"))
+        assert "sha256sum -- '/etc/a b'" in conn.run.call_args[0][0]
+
+    def test_put_skips_identical(self, ra, tmp_path):
+        import asyncio
+        import hashlib
+        from unittest.mock import AsyncMock
+        (tmp_path / "c").write_bytes(b"cert")
+        conn, sftp = self._conn(stdout=hashlib.sha256(b"cert").hexdigest() + "\n")
+        with patch("asyncssh.connect", AsyncMock(return_value=conn)):
+            assert asyncio.run(ra.put("h", tmp_path / "c", "/etc/c")) is False
+        sftp.open.assert_not_called()
+
+    def test_put_uploads_changed(self, ra, tmp_path):
+        import asyncio
+        from unittest.mock import AsyncMock
+        (tmp_path / "c").write_bytes(b"cert")
+        conn, sftp = self._conn(stdout="")
+        with patch("asyncssh.connect", AsyncMock(return_value=conn)):
+            assert asyncio.run(ra.put("h", tmp_path / "c", "/etc/c")) is True
+        # created 0600 under a temp name, then renamed into place
+        path, mode, attrs = sftp.open.call_args[0]
+        assert (path, mode, attrs.permissions) == ("/etc/c.tmp", "wb", 0o600)
+        sftp.file.write.assert_awaited_once_with(b"cert")
+        attrs = sftp.setstat.call_args[0][1]
+        assert attrs.mtime == int((tmp_path / "c").stat().st_mtime)
+        sftp.posix_rename.assert_awaited_once_with("/etc/c.tmp", "/etc/c")
+        sftp.remove.assert_not_called()
+
+    def test_put_removes_temp_on_failure(self, ra, tmp_path):
+        import asyncio
+        import asyncssh
+        from unittest.mock import AsyncMock
+        (tmp_path / "c").write_bytes(b"cert")
+        conn, sftp = self._conn(stdout="")
+        sftp.posix_rename.side_effect = asyncssh.SFTPFailure("no")
+        with patch("asyncssh.connect", AsyncMock(return_value=conn)):
+            with pytest.raises(ra.RemoteError):
+                asyncio.run(ra.put("h", tmp_path / "c", "/etc/c"))
+        sftp.remove.assert_awaited_once_with("/etc/c.tmp")
+
+
+# ═══════════════════════════════════════════════════
+# lib/diffcolor.py
+# ═══════════════════════════════════════════════════
+
+
+class TestDiffColor:
+    def test_colors_lines(self, monkeypatch):
+        monkeypatch.delenv("NO_COLOR", raising=False)
+        from lib.diffcolor import colored_udiff
+        out = list(colored_udiff("a\nb\n", "a\nc\n", "remote", "rendered"))
+        assert out[0] == "\033[1m--- remote\033[0m\n"
+        assert out[2].startswith("\033[36m@@")
+        assert "\033[31m-b\033[0m\n" in out
+        assert "\033[32m+c\033[0m\n" in out
+        assert " a\n" in out
+
+    def test_header_only_first_two_lines(self, monkeypatch):
+        monkeypatch.delenv("NO_COLOR", raising=False)
+        from lib.diffcolor import colored_udiff
+        out = list(colored_udiff("---\nx\n", "++y\nx\n"))
+        assert "\033[31m----\033[0m\n" in out
+        assert "\033[32m+++y\033[0m\n" in out
+
+    def test_no_color(self, monkeypatch):
+        monkeypatch.setenv("NO_COLOR", "1")
+        from lib.diffcolor import colored_udiff
+        out = "".join(colored_udiff("a\n", "b\n"))
+        assert "\033[" not in out
+        assert "-a\n+b\n" in out
+
+    def test_missing_trailing_newline(self, monkeypatch):
+        monkeypatch.setenv("NO_COLOR", "1")
+        from lib.diffcolor import colored_udiff
+        out = list(colored_udiff("x", "y"))
+        assert all(line.endswith("\n") for line in out)
+        assert "-x\n" in out and "+y\n" in out
+
+    def test_identical_is_empty(self):
+        from lib.diffcolor import colored_udiff
+        assert list(colored_udiff("same\n", "same\n")) == []
 
 
 # ═══════════════════════════════════════════════════
@@ -367,6 +849,44 @@ class TestDeployHelpers:
         assert _fmt_opts(opts) == expected
 
 
+class TestRunParallel:
+    def test_output_not_interleaved(self, capsys):
+        import threading
+        from lib.deploy import _run_parallel
+        barrier = threading.Barrier(3)
+
+        def job(name):
+            print(f"{name} start")
+            barrier.wait(timeout=5)
+            print(f"{name} end")
+
+        _run_parallel(job, ["a", "b", "c"])
+        lines = capsys.readouterr().out.splitlines()
+        for i in range(0, 6, 2):
+            name = lines[i].split()[0]
+            assert lines[i:i + 2] == [f"{name} start", f"{name} end"]
+
+    def test_failure_exits_after_all_instances(self, capsys):
+        from lib.deploy import _run_parallel
+        done = []
+
+        def job(name):
+            if name == "bad":
+                sys.exit(1)
+            done.append(name)
+
+        with pytest.raises(SystemExit):
+            _run_parallel(job, ["ok1", "bad", "ok2"])
+        assert sorted(done) == ["ok1", "ok2"]
+        assert "bad" in capsys.readouterr().err
+
+    def test_restores_stdout(self):
+        from lib.deploy import _run_parallel
+        before = sys.stdout
+        _run_parallel(lambda n: None, ["a", "b"])
+        assert sys.stdout is before
+
+
 class TestServiceDeployer:
     def _make_deployer(self, tmp_path, **overrides):
         from lib.deploy import ServiceDeployer
@@ -454,6 +974,48 @@ class TestServiceDeployer:
         secrets = {"instances": {"i1": {"host": "srv2"}}}
         assert d._get_host_ref(secrets, "i1") == "srv2"
 
+    # ── _preload_templates ──
+
+    def test_preload_templates_loads_each_once(self, tmp_path):
+        d = self._make_deployer(
+            tmp_path,
+            files=lambda s, i: [("a.j2", f"/opt/{i}/a"), ("b.j2", f"/opt/{i}/b")],
+            multi_instance=True,
+        )
+        env = MagicMock()
+        d._preload_templates(env, {}, ["i1", "i2"])
+        assert sorted(c.args[0] for c in env.get_template.call_args_list) == ["a.j2", "b.j2"]
+
+    def test_render_memoized_by_context(self, tmp_path):
+        (tmp_path / "t.j2").write_text("v={{ v }}\n")
+        d = self._make_deployer(tmp_path)
+        from lib.jinja import create_jinja_env
+        env = create_jinja_env(tmp_path)
+        with patch.object(env, "get_template", wraps=env.get_template) as get:
+            assert d._render(env, "t.j2", {"v": 1}) == "v=1\n"
+            assert d._render(env, "t.j2", {"v": 1}) == "v=1\n"
+            assert d._render(env, "t.j2", {"v": 2}) == "v=2\n"
+        assert get.call_count == 2
+
+    def test_render_memo_mixed_key_types(self, tmp_path):
+        (tmp_path / "t.j2").write_text("{{ ports }}\n")
+        d = self._make_deployer(tmp_path)
+        from lib.jinja import create_jinja_env
+        env = create_jinja_env(tmp_path)
+        assert d._render(env, "t.j2", {"ports": {80: "http", "web": 8080}}) == \
+            "{80: 'http', 'web': 8080}\n"
+        # int and str keys are different contexts, not one memo entry
+        assert d._render(env, "t.j2", {"ports": {1: "x"}}) == "{1: 'x'}\n"
+        assert d._render(env, "t.j2", {"ports": {"1": "x"}}) == "{'1': 'x'}\n"
+        assert len(d._rendered) == 3
+
+    def test_render_unhashable_context_skips_memo(self, tmp_path):
+        (tmp_path / "t.j2").write_text("{{ s | length }}\n")
+        d = self._make_deployer(tmp_path)
+        from lib.jinja import create_jinja_env
+        assert d._render(create_jinja_env(tmp_path), "t.j2", {"s": {1, 2}}) == "2\n"
+        assert d._rendered == {}
+
     # ── render ──
 
     def test_render_single(self, tmp_path, capsys):
@@ -494,12 +1056,90 @@ class TestServiceDeployer:
         assert "root:root" in out
         assert "600" in out
 
+    # ── diff ──
+
+    @patch("lib.deploy.ssh_read_files")
+    @patch("lib.deploy.ssh_sha256_many")
+    def test_diff_hash_match_skips_fetch(self, mock_hash, mock_read, tmp_path, capsys):
+        import hashlib
+        (tmp_path / "t.j2").write_text("content\n")
+        mock_hash.return_value = {"/opt/conf": hashlib.sha256(b"content\n").hexdigest()}
+        d = self._make_deployer(tmp_path, files=[("t.j2", "/opt/conf")])
+        from lib.jinja import create_jinja_env
+        d.diff({"srv1": {"address": "s.example.com"}}, {"host": "srv1"},
+               create_jinja_env(tmp_path))
+        mock_read.assert_not_called()
+        assert "differs" not in capsys.readouterr().out
+
+    @patch("lib.deploy.ssh_read_files", return_value={"/opt/conf": b"old\n"})
+    @patch("lib.deploy.ssh_sha256_many", return_value={})
+    def test_diff_hash_mismatch_fetches(self, mock_hash, mock_read, tmp_path, capsys, monkeypatch):
+        monkeypatch.setenv("NO_COLOR", "1")
+        (tmp_path / "t.j2").write_text("new\n")
+        d = self._make_deployer(tmp_path, files=[("t.j2", "/opt/conf")])
+        from lib.jinja import create_jinja_env
+        d.diff({"srv1": {"address": "s.example.com"}}, {"host": "srv1"},
+               create_jinja_env(tmp_path))
+        mock_read.assert_called_once()
+        out = capsys.readouterr().out
+        assert "t differs" in out
+        assert "\n-old\n+new\n" in out
+
+    @patch("lib.deploy.ssh_read_files", return_value={"/opt/conf": b"same\n"})
+    @patch("lib.deploy.ssh_sha256_many", return_value={})
+    def test_diff_falls_back_to_bytes(self, mock_hash, mock_read, tmp_path, capsys):
+        (tmp_path / "t.j2").write_text("same\n")
+        d = self._make_deployer(tmp_path, files=[("t.j2", "/opt/conf")])
+        from lib.jinja import create_jinja_env
+        d.diff({"srv1": {"address": "s.example.com"}}, {"host": "srv1"},
+               create_jinja_env(tmp_path))
+        assert "differs" not in capsys.readouterr().out
+
+    @patch("lib.deploy.ssh_read_files")
+    @patch("lib.deploy.ssh_sha256_many")
+    def test_diff_batches_remote_calls(self, mock_hash, mock_read, tmp_path, capsys):
+        import hashlib
+        (tmp_path / "a.j2").write_text("a\n")
+        (tmp_path / "b.j2").write_text("b\n")
+        (tmp_path / "c.j2").write_text("c\n")
+        mock_hash.return_value = {"/opt/a": hashlib.sha256(b"a\n").hexdigest()}
+        mock_read.return_value = {"/opt/b": b"", "/opt/c": b"x\n"}
+        d = self._make_deployer(tmp_path, files=[
+            ("a.j2", "/opt/a"), ("b.j2", "/opt/b"), ("c.j2", "/opt/c"),
+        ])
+        from lib.jinja import create_jinja_env
+        d.diff({"srv1": {"address": "s.example.com"}}, {"host": "srv1"},
+               create_jinja_env(tmp_path))
+        mock_hash.assert_called_once()
+        assert mock_hash.call_args[0][1] == ["/opt/a", "/opt/b", "/opt/c"]
+        mock_read.assert_called_once()
+        assert mock_read.call_args[0][1] == ["/opt/b", "/opt/c"]
+
+    @patch("lib.deploy.ssh_read_files")
+    @patch("lib.deploy.ssh_sha256_many", return_value={})
+    def test_diff_parallel_keeps_blocks(self, mock_hash, mock_read, tmp_path, capsys, monkeypatch):
+        monkeypatch.setenv("NO_COLOR", "1")
+        from lib.deploy import _run_parallel
+        from lib.jinja import create_jinja_env
+        (tmp_path / "t.j2").write_text("{{ instance.v }}\n")
+        mock_read.side_effect = lambda target, paths, port: {p: b"old\n" for p in paths}
+        d = self._make_deployer(tmp_path, files=[("t.j2", "/opt/conf")], multi_instance=True)
+        secrets = {"instances": {"i1": {"host": "srv1", "v": "one"},
+                                 "i2": {"host": "srv2", "v": "two"}}}
+        hosts = {"srv1": {"address": "a"}, "srv2": {"address": "b"}}
+        env = create_jinja_env(tmp_path)
+        _run_parallel(lambda inst: d.diff(hosts, secrets, env, inst), ["i1", "i2"])
+        out = capsys.readouterr().out
+        for name, v in (("i1", "one"), ("i2", "two")):
+            start = out.index(f"── {name} ")
+            block = out[start:start + out[start:].index("\n\n") + 1]
+            assert block.endswith(f"-old\n+{v}\n")
+
     # ── deploy ──
 
-    @patch("lib.deploy.rsync_file", return_value=True)
-    @patch("lib.deploy._apply_opts")
-    @patch("lib.deploy.ssh_run")
-    def test_deploy_restarts_on_change(self, mock_ssh, mock_opts, mock_rsync, tmp_path, capsys):
+    @patch("lib.deploy.rsync_many", side_effect=lambda d, t, fm, p, **kw: {rp for _, rp in fm})
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_restarts_on_change(self, mock_script, mock_rsync, tmp_path, capsys):
         (tmp_path / "t.j2").write_text("content\n")
         d = self._make_deployer(
             tmp_path,
@@ -510,14 +1150,13 @@ class TestServiceDeployer:
         hosts = {"srv1": {"address": "s.example.com"}}
         secrets = {"host": "srv1"}
         d.deploy(hosts, secrets, create_jinja_env(tmp_path))
-        # restart_cmd was executed
-        restart_calls = [c for c in mock_ssh.call_args_list if "restart" in str(c)]
-        assert len(restart_calls) == 1
+        # restart_cmd was executed in the post-deploy script
+        mock_script.assert_called_once()
+        assert "systemctl restart svc" in mock_script.call_args[0][1]
 
-    @patch("lib.deploy.rsync_file", return_value=False)
-    @patch("lib.deploy._apply_opts")
-    @patch("lib.deploy.ssh_run")
-    def test_deploy_no_restart_when_unchanged(self, mock_ssh, mock_opts, mock_rsync, tmp_path, capsys):
+    @patch("lib.deploy.rsync_many", return_value=set())
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_no_restart_when_unchanged(self, mock_script, mock_rsync, tmp_path, capsys):
         (tmp_path / "t.j2").write_text("content\n")
         d = self._make_deployer(
             tmp_path,
@@ -528,14 +1167,12 @@ class TestServiceDeployer:
         hosts = {"srv1": {"address": "s.example.com"}}
         secrets = {"host": "srv1"}
         d.deploy(hosts, secrets, create_jinja_env(tmp_path))
-        restart_calls = [c for c in mock_ssh.call_args_list if "restart" in str(c)]
-        assert len(restart_calls) == 0
+        mock_script.assert_not_called()
         assert "no changes" in capsys.readouterr().out
 
-    @patch("lib.deploy.rsync_file", return_value=True)
-    @patch("lib.deploy._apply_opts")
-    @patch("lib.deploy.ssh_run")
-    def test_deploy_no_restart_flag(self, mock_ssh, mock_opts, mock_rsync, tmp_path, capsys):
+    @patch("lib.deploy.rsync_many", side_effect=lambda d, t, fm, p, **kw: {rp for _, rp in fm})
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_no_restart_flag(self, mock_script, mock_rsync, tmp_path, capsys):
         (tmp_path / "t.j2").write_text("content\n")
         d = self._make_deployer(
             tmp_path,
@@ -546,13 +1183,12 @@ class TestServiceDeployer:
         hosts = {"srv1": {"address": "s.example.com"}}
         secrets = {"host": "srv1"}
         d.deploy(hosts, secrets, create_jinja_env(tmp_path), no_restart=True)
-        restart_calls = [c for c in mock_ssh.call_args_list if "restart" in str(c)]
+        restart_calls = [c for c in mock_script.call_args_list if "restart" in str(c)]
         assert len(restart_calls) == 0
 
-    @patch("lib.deploy.rsync_file", return_value=False)
-    @patch("lib.deploy._apply_opts")
-    @patch("lib.deploy.ssh_run")
-    def test_deploy_creates_setup_dirs(self, mock_ssh, mock_opts, mock_rsync, tmp_path):
+    @patch("lib.deploy.rsync_many", return_value=set())
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_creates_setup_dirs(self, mock_script, mock_rsync, tmp_path):
         (tmp_path / "t.j2").write_text("x\n")
         d = self._make_deployer(
             tmp_path,
@@ -563,13 +1199,13 @@ class TestServiceDeployer:
         hosts = {"srv1": {"address": "s.example.com"}}
         secrets = {"host": "srv1"}
         d.deploy(hosts, secrets, create_jinja_env(tmp_path))
-        mkdir_calls = [c for c in mock_ssh.call_args_list if "mkdir" in str(c)]
-        assert len(mkdir_calls) == 1
-        assert "/opt/svc" in str(mkdir_calls[0])
+        # directories are created inside the rsync session, no separate ssh call
+        assert mock_rsync.call_args.kwargs["setup_dirs"] == ["/opt/svc", "/opt/svc/data"]
+        mock_script.assert_not_called()
 
-    @patch("lib.deploy.rsync_file", return_value=True)
-    @patch("lib.deploy.ssh_run")
-    def test_deploy_applies_opts(self, mock_ssh, mock_rsync, tmp_path):
+    @patch("lib.deploy.rsync_many", side_effect=lambda d, t, fm, p, **kw: {rp for _, rp in fm})
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_applies_opts(self, mock_script, mock_rsync, tmp_path):
         (tmp_path / "t.j2").write_text("x\n")
         d = self._make_deployer(
             tmp_path,
@@ -579,13 +1215,60 @@ class TestServiceDeployer:
         hosts = {"srv1": {"address": "s.example.com"}}
         secrets = {"host": "srv1"}
         d.deploy(hosts, secrets, create_jinja_env(tmp_path))
-        chown_chmod = [c for c in mock_ssh.call_args_list if "chown" in str(c) or "chmod" in str(c)]
-        assert len(chown_chmod) >= 1
+        script = mock_script.call_args[0][1]
+        assert "chown root:root /etc/wg0.conf" in script
+        assert "chmod 600 /etc/wg0.conf" in script
 
-    @patch("lib.deploy.rsync_file", return_value=True)
-    @patch("lib.deploy._apply_opts")
-    @patch("lib.deploy.ssh_run")
-    def test_deploy_calls_secrets_hooks(self, mock_ssh, mock_opts, mock_rsync, tmp_path):
+    @patch("lib.deploy.rsync_many", side_effect=lambda d, t, fm, p, **kw: {rp for _, rp in fm})
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_single_post_script(self, mock_script, mock_rsync, tmp_path):
+        (tmp_path / "t.j2").write_text("x\n")
+        d = self._make_deployer(
+            tmp_path,
+            files=[("t.j2", "/etc/a", {"mode": "600"}), ("t.j2", "/etc/b", {"owner": "33:33"})],
+            restart_cmd="systemctl restart svc",
+        )
+        from lib.jinja import create_jinja_env
+        d.deploy({"srv1": {"address": "s.example.com"}}, {"host": "srv1"},
+                 create_jinja_env(tmp_path))
+        mock_script.assert_called_once()
+        assert mock_script.call_args[0][1] == (
+            "set -e\nchmod 600 /etc/a\nchown 33:33 /etc/b\nset +e\nsystemctl restart svc\n"
+        )
+
+    @patch("lib.deploy.rsync_many", side_effect=lambda d, t, fm, p, **kw: {rp for _, rp in fm})
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_restart_cmd_not_under_set_e(self, mock_script, mock_rsync, tmp_path):
+        # e.g. sing-box: a failing `reset-failed` must not stop the restart
+        (tmp_path / "t.j2").write_text("x\n")
+        (tmp_path / "a").write_text("x\n")
+        d = self._make_deployer(
+            tmp_path, files=[("t.j2", str(tmp_path / "a"), {"mode": "600"})],
+            restart_cmd="true && false 2>/dev/null; echo restarted",
+        )
+        from lib.jinja import create_jinja_env
+        d.deploy({"srv1": {"address": "s.example.com"}}, {"host": "srv1"},
+                 create_jinja_env(tmp_path))
+        # run the generated script locally, as the remote bash -s would
+        out = subprocess.run(["bash", "-c", mock_script.call_args[0][1]],
+                             capture_output=True, text=True)
+        assert out.returncode == 0
+        assert out.stdout == "restarted\n"
+
+    @patch("lib.deploy.rsync_many", side_effect=lambda d, t, fm, p, **kw: {rp for _, rp in fm})
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_restart_without_fixups(self, mock_script, mock_rsync, tmp_path):
+        (tmp_path / "t.j2").write_text("x\n")
+        d = self._make_deployer(tmp_path, files=[("t.j2", "/etc/a")],
+                                restart_cmd="systemctl restart svc")
+        from lib.jinja import create_jinja_env
+        d.deploy({"srv1": {"address": "s.example.com"}}, {"host": "srv1"},
+                 create_jinja_env(tmp_path))
+        assert mock_script.call_args[0][1] == "set +e\nsystemctl restart svc\n"
+
+    @patch("lib.deploy.rsync_many", side_effect=lambda d, t, fm, p, **kw: {rp for _, rp in fm})
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_calls_secrets_hooks(self, mock_script, mock_rsync, tmp_path):
         (tmp_path / "t.j2").write_text("x\n")
         hook = MagicMock()
         d = self._make_deployer(
@@ -601,10 +1284,9 @@ class TestServiceDeployer:
         # hook receives (secrets, target, port)
         assert hook.call_args[0][0] is secrets
 
-    @patch("lib.deploy.rsync_file", return_value=True)
-    @patch("lib.deploy._apply_opts")
-    @patch("lib.deploy.ssh_run")
-    def test_deploy_callable_restart_cmd(self, mock_ssh, mock_opts, mock_rsync, tmp_path, capsys):
+    @patch("lib.deploy.rsync_many", side_effect=lambda d, t, fm, p, **kw: {rp for _, rp in fm})
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_callable_restart_cmd(self, mock_script, mock_rsync, tmp_path, capsys):
         (tmp_path / "t.j2").write_text("content\n")
         d = self._make_deployer(
             tmp_path,
@@ -618,10 +1300,69 @@ class TestServiceDeployer:
             "instances": {"i1": {"host": "srv1", "image": "ghcr.io/app:latest"}},
         }
         d.deploy(hosts, secrets, create_jinja_env(tmp_path), instance_name="i1")
-        restart_calls = [c for c in mock_ssh.call_args_list if "podman pull" in str(c)]
+        restart_calls = [c for c in mock_script.call_args_list if "podman pull" in str(c)]
         assert len(restart_calls) == 1
         assert "ghcr.io/app:latest" in str(restart_calls[0])
 
+    @patch("lib.deploy.rsync_many", return_value=set())
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_shared_staging_root(self, mock_script, mock_rsync, tmp_path):
+        tpl_dir = tmp_path / "tpl"
+        tpl_dir.mkdir()
+        (tpl_dir / "t.j2").write_text("x\n")
+        d = self._make_deployer(tpl_dir, files=[("t.j2", "/opt/conf")], multi_instance=True)
+        from lib.jinja import create_jinja_env
+        hosts = {"srv1": {"address": "s.example.com"}}
+        secrets = {"instances": {"i1": {"host": "srv1"}}}
+        d.deploy(hosts, secrets, create_jinja_env(tpl_dir), "i1", staging_root=tmp_path / "root")
+        assert mock_rsync.call_args[0][0] == tmp_path / "root" / "i1"
+        assert (tmp_path / "root" / "i1" / "opt" / "conf").read_text() == "x\n"
+
+    @patch("lib.deploy.rsync_many", return_value=set())
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_stamps_mtime_from_content(self, mock_script, mock_rsync, tmp_path):
+        tpl_dir = tmp_path / "tpl"
+        tpl_dir.mkdir()
+        (tpl_dir / "a.j2").write_text("same\n")
+        (tpl_dir / "b.j2").write_text("same\n")
+        (tpl_dir / "c.j2").write_text("other\n")
+        d = self._make_deployer(tpl_dir, files=[("a.j2", "/a"), ("b.j2", "/b"), ("c.j2", "/c")])
+        from lib.jinja import create_jinja_env
+        hosts = {"srv1": {"address": "s.example.com"}}
+        d.deploy(hosts, {"host": "srv1"}, create_jinja_env(tpl_dir), staging_root=tmp_path / "root")
+        mtimes = {rp: lp.stat().st_mtime for lp, rp in mock_rsync.call_args[0][2]}
+        assert mtimes["/a"] == mtimes["/b"] != mtimes["/c"]
+        # well inside 32-bit time_t, in the recent past
+        assert all(1_600_000_000 <= t < 1_600_000_000 + (1 << 28) for t in mtimes.values())
+        assert mock_rsync.call_args.kwargs["force"] is False
+
+    @patch("lib.deploy.rsync_many", return_value=set())
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_force(self, mock_script, mock_rsync, tmp_path):
+        (tmp_path / "t.j2").write_text("x\n")
+        d = self._make_deployer(tmp_path, files=[("t.j2", "/opt/conf")])
+        from lib.jinja import create_jinja_env
+        hosts = {"srv1": {"address": "s.example.com"}}
+        d.deploy(hosts, {"host": "srv1"}, create_jinja_env(tmp_path), force=True)
+        assert mock_rsync.call_args.kwargs["force"] is True
+
+    @patch("lib.deploy.ssh_sha256_many")
+    @patch("lib.deploy.rsync_many", return_value=set())
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_unchanged_is_one_rsync(self, mock_script, mock_rsync, mock_hashes, tmp_path):
+        # stamped mtimes make an unchanged file a stat-only no-op in rsync,
+        # so a repeat deploy needs no extra hash round trip
+        (tmp_path / "t.j2").write_text("x\n")
+        d = self._make_deployer(tmp_path, files=[("t.j2", "/opt/conf")])
+        from lib.jinja import create_jinja_env
+        hosts = {"srv1": {"address": "s.example.com"}}
+        env = create_jinja_env(tmp_path)
+        d.deploy(hosts, {"host": "srv1"}, env)
+        d.deploy(hosts, {"host": "srv1"}, env)
+        assert mock_rsync.call_count == 2
+        mock_hashes.assert_not_called()
+        mock_script.assert_not_called()
+
     # ── callable files/setup_dirs ──
 
     def test_render_callable_files(self, tmp_path, capsys):
@@ -644,10 +1385,9 @@ class TestServiceDeployer:
         out = capsys.readouterr().out
         assert "/opt/conf" in out
 
-    @patch("lib.deploy.rsync_file", return_value=True)
-    @patch("lib.deploy._apply_opts")
-    @patch("lib.deploy.ssh_run")
-    def test_deploy_callable_files(self, mock_ssh, mock_opts, mock_rsync, tmp_path):
+    @patch("lib.deploy.rsync_many", side_effect=lambda d, t, fm, p, **kw: {rp for _, rp in fm})
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_callable_files(self, mock_script, mock_rsync, tmp_path):
         (tmp_path / "t.j2").write_text("x\n")
 
         def make_files(secrets, instance_name):
@@ -661,10 +1401,9 @@ class TestServiceDeployer:
         rsync_calls = [str(c) for c in mock_rsync.call_args_list]
         assert any("/opt/i1/conf" in c for c in rsync_calls)
 
-    @patch("lib.deploy.rsync_file", return_value=True)
-    @patch("lib.deploy._apply_opts")
-    @patch("lib.deploy.ssh_run")
-    def test_deploy_callable_setup_dirs(self, mock_ssh, mock_opts, mock_rsync, tmp_path):
+    @patch("lib.deploy.rsync_many", side_effect=lambda d, t, fm, p, **kw: {rp for _, rp in fm})
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_callable_setup_dirs(self, mock_script, mock_rsync, tmp_path):
         (tmp_path / "t.j2").write_text("x\n")
 
         def make_setup_dirs(secrets, instance_name):
@@ -680,14 +1419,11 @@ class TestServiceDeployer:
         hosts = {"srv1": {"address": "s.example.com"}}
         secrets = {"instances": {"i1": {"host": "srv1"}}}
         d.deploy(hosts, secrets, create_jinja_env(tmp_path), instance_name="i1")
-        mkdir_calls = [str(c) for c in mock_ssh.call_args_list if "mkdir" in str(c)]
-        assert any("/opt/i1/data" in c for c in mkdir_calls)
-        assert any("/opt/i1/cache" in c for c in mkdir_calls)
-
-    @patch("lib.deploy.rsync_file", return_value=True)
-    @patch("lib.deploy._apply_opts")
-    @patch("lib.deploy.ssh_run")
-    def test_deploy_callable_setup_dirs_static_fallback(self, mock_ssh, mock_opts, mock_rsync, tmp_path):
+        assert mock_rsync.call_args.kwargs["setup_dirs"] == ["/opt/i1/data", "/opt/i1/cache"]
+
+    @patch("lib.deploy.rsync_many", side_effect=lambda d, t, fm, p, **kw: {rp for _, rp in fm})
+    @patch("lib.deploy.ssh_run_script")
+    def test_deploy_callable_setup_dirs_static_fallback(self, mock_script, mock_rsync, tmp_path):
         (tmp_path / "t.j2").write_text("x\n")
         d = self._make_deployer(
             tmp_path,
@@ -698,5 +1434,4 @@ class TestServiceDeployer:
         hosts = {"srv1": {"address": "s.example.com"}}
         secrets = {"host": "srv1"}
         d.deploy(hosts, secrets, create_jinja_env(tmp_path))
-        mkdir_calls = [str(c) for c in mock_ssh.call_args_list if "mkdir" in str(c)]
-        assert any("/opt/static/data" in c for c in mkdir_calls)
+        assert mock_rsync.call_args.kwargs["setup_dirs"] == ["/opt/static/data"]